@@ -0,0 +1,70 @@
+import os
+import pandas as pd
+
+from excel_manager import EXTRACT_FIELDS, EXTRACT_LIST_COLUMNS
+
+# Typed copy of the merged dataset, written next to the Excel output so
+# other tooling can read a few columns without openpyxl or the Sheets API.
+EXPORT_DIR = os.getenv("SNAPSHOT_EXPORT_DIR", "exports")
+EXPORT_BASENAME = "運営園"
+
+# Checkbox fields are exported as "a, b" text (same as the Excel sheet)
+_LIST_FIELDS = {EXTRACT_FIELDS[h] for h in EXTRACT_LIST_COLUMNS}
+
+def _number_series(values):
+    """Int64 when every value is whole (or missing), else Float64."""
+    series = pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").astype("Float64")
+    if ((series % 1) == 0).fillna(True).all():
+        return series.astype("Int64")
+    return series
+
+def build_snapshot_frame(merged_data):
+    """
+    One typed row per nursery of merged_data, in list order: App 218 fields,
+    the bed aggregate and how the bed record was matched.
+    """
+    masters = [item['master'] for item in merged_data]
+
+    def column(field):
+        values = [m.get(field, "") for m in masters]
+        if field in _LIST_FIELDS:
+            values = [", ".join(v) if isinstance(v, (list, tuple)) else v for v in values]
+        return pd.Series(values, dtype="string")
+
+    df = pd.DataFrame({
+        "record_id": pd.to_numeric(pd.Series([m.get("$id", "") for m in masters], dtype=object), errors="coerce").astype("Int64"),
+        "name": column("name"),
+        "client_name": column("client_name"),
+        "status": column("status"),
+        "capacity": pd.to_numeric(column("capacity"), errors="coerce").astype("Int64"),
+        "open_date": pd.to_datetime(column("open_date"), errors="coerce", format="%Y-%m-%d"),
+        "addr_area": column("addr_area"),
+        "addr_city": column("addr_city"),
+    })
+    for field in EXTRACT_FIELDS.values():
+        if field in _LIST_FIELDS:
+            df[field] = column(field)
+
+    # Bed counts are summed from Kintone numbers and may be fractional
+    df["bed_total"] = _number_series([item.get('bed_total', 0) for item in merged_data])
+    df["bed_records"] = _number_series([item.get('bed_records', 0) for item in merged_data])
+    df["bed_conflict"] = pd.Series([bool(item.get('bed_conflict')) for item in merged_data], dtype="boolean")
+    df["match_status"] = pd.Series([item.get('status', "") for item in merged_data], dtype="string")
+    df["match_rule"] = pd.Series([item.get('match_rule') or "" for item in merged_data], dtype="string")
+    return df
+
+def export_snapshot(merged_data, config_date, directory=EXPORT_DIR):
+    """
+    Write merged_data as <directory>/運営園_YYYYMMDD.parquet and return the path.
+    Without a Parquet engine (pyarrow / fastparquet) a gzip CSV is written
+    instead (.csv.gz, dates as YYYY-MM-DD).
+    """
+    df = build_snapshot_frame(merged_data)
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.join(directory, f"{EXPORT_BASENAME}_{config_date.strftime('%Y%m%d')}")
+    try:
+        df.to_parquet(stem + ".parquet", index=False)
+        return stem + ".parquet"
+    except ImportError:
+        df.to_csv(stem + ".csv.gz", index=False, compression="gzip", date_format="%Y-%m-%d")
+        return stem + ".csv.gz"
@@ -1,73 +1,363 @@
 import os
+import re
+import hashlib
+import threading
+import unicodedata
+from collections import Counter
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from google import genai
 from google.genai import types
 import json
+import fuzzy_matcher
+from file_utils import replace_file
 
-def get_gemini_match(nursery_name, candidates):
+# --- Name normalization ---
+# Facility ID field, used as the first join key when both apps carry it
+# (add it to kintone_client.NURSERY_FIELDS / BED_FIELDS to enable).
+FACILITY_ID_FIELD = "施設ID"
+
+# Corporate designations, removed wherever they appear in the name
+CORPORATE_PATTERNS = [
+    "株式会社", "有限会社", "合同会社", "(株)", "(有)", "(医)", "(福)", "(社福)",
+    "社会福祉法人", "医療法人社団", "医療法人財団", "医療法人", "学校法人",
+    "一般社団法人", "一般財団法人", "公益社団法人", "公益財団法人",
+    "特定非営利活動法人", "npo法人",
+]
+# Facility type suffixes, removed at the end of the name (longest first)
+FACILITY_SUFFIXES = sorted([
+    "院内保育所", "院内保育園", "院内保育室", "事業所内保育所", "事業所内保育園",
+    "保育園", "保育所", "保育室", "保育ルーム", "託児所", "託児室", "こども園", "子ども園",
+], key=len, reverse=True)
+_PUNCT_RE = re.compile(r"[\s・･,、.。'\"()\[\]{}「」『』【】〈〉《》-]")
+_CORPORATE_RE = re.compile("|".join(re.escape(p) for p in CORPORATE_PATTERNS))
+# Katakana -> hiragana
+_KANA_TABLE = {c: c - 0x60 for c in range(ord("ァ"), ord("ヶ") + 1)}
+_SUFFIX_RE = re.compile("(?:" + "|".join(re.escape(s.translate(_KANA_TABLE)) for s in FACILITY_SUFFIXES) + ")$")
+
+# Match rules, most reliable first. Reported as merged_item["match_rule"].
+MATCH_RULES = ["facility_id", "exact", "nfkc", "kana", "stripped", "ngram", "gemini"]
+
+@lru_cache(maxsize=100000)
+def name_keys(name):
     """
-    Use Gemini to find the best match for a nursery name from a list of candidates.
+    Normalized keys of a facility name, one per rule (exact -> most folded).
+    nfkc:     NFKC (full/half width), lower case, no whitespace
+    kana:     + katakana -> hiragana, punctuation removed
+    stripped: + corporate designations and facility type suffixes removed
+    Cached: the same names are looked up by the index and the fuzzy matcher.
+    Do not modify the returned dict.
+    """
+    exact = str(name).strip()
+    nfkc = re.sub(r"\s+", "", unicodedata.normalize("NFKC", exact)).lower()
+    kana = _PUNCT_RE.sub("", nfkc.translate(_KANA_TABLE))
+
+    stripped = _PUNCT_RE.sub("", _CORPORATE_RE.sub("", nfkc).translate(_KANA_TABLE))
+    m = _SUFFIX_RE.search(stripped)
+    if m and m.start() > 0:
+        stripped = stripped[:m.start()]
+
+    return {"exact": exact, "nfkc": nfkc, "kana": kana, "stripped": stripped or kana}
+
+class NameIndex:
+    """
+    Hash index of records by facility ID and by each normalized name key.
+    Built once per run in a single pass; every lookup is a few dict probes.
+
+    Records are grouped: each key maps to the list of ALL records with that
+    facility ID / name key, so one-to-many joins keep every record.
+    The nfkc and kana keys only fold width, case, whitespace and kana, so
+    names sharing one are spellings of the same facility and are grouped.
+    A stripped key shared by records with different names can be different
+    facilities: it is ambiguous and is not used for matching.
+    """
+    _AMBIGUOUS = object()
+    _GROUPED_RULES = ("nfkc", "kana")
+
+    def __init__(self, records, name_field, id_field=FACILITY_ID_FIELD):
+        self.id_field = id_field
+        self.keys = {rule: {} for rule in MATCH_RULES}
+        groups = self.keys["exact"] # exact name -> [records]
+        stripped = self.keys["stripped"]
+        for r in records:
+            name = r.get(name_field, "")
+            fid = r.get(id_field, "") if id_field in r else ""
+            if fid:
+                self.keys["facility_id"].setdefault(str(fid).strip(), []).append(r)
+            if not name:
+                continue
+            keys = name_keys(name)
+            group = groups.setdefault(keys["exact"], [])
+            group.append(r)
+            for rule in self._GROUPED_RULES:
+                if keys[rule]:
+                    self.keys[rule].setdefault(keys[rule], []).append(r)
+            key = keys["stripped"]
+            if key:
+                existing = stripped.get(key)
+                if existing is None:
+                    stripped[key] = group
+                elif existing is not group:
+                    stripped[key] = self._AMBIGUOUS
+
+    def lookup(self, name, facility_id=""):
+        """Return (records, rule) for the first rule that matches, else (None, None)."""
+        if facility_id:
+            hit = self.keys["facility_id"].get(str(facility_id).strip())
+            if hit is not None:
+                return hit, "facility_id"
+        if not name:
+            return None, None
+        for rule, key in name_keys(name).items():
+            hit = self.keys[rule].get(key)
+            if hit is not None and hit is not self._AMBIGUOUS:
+                return hit, rule
+        return None, None
+
+def _to_number(value):
+    """Kintone NUMBER value -> int/float, None if not a number."""
+    if value in ("", None):
+        return 0
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+def aggregate_beds(records, field="病床数合計_0"):
+    """
+    Aggregate the bed records joined to one nursery.
+    Returns (total, count, conflict): conflict is True when several records
+    disagree on the bed count or a value is not a number.
+    """
+    if not records:
+        return 0, 0, False
+    values = [_to_number(r.get(field, "")) for r in records]
+    conflict = None in values or len(set(values)) > 1
+    total = sum(v for v in values if v is not None)
+    if isinstance(total, float) and total.is_integer():
+        total = int(total)
+    return total, len(records), conflict
+
+def match_summary(merged):
+    """Count of merged rows per match rule ("unmatched" for no match)."""
+    return Counter(m.get("match_rule") or "unmatched" for m in merged)
+
+# --- Gemini fuzzy matching (batched, cached) ---
+GEMINI_MODEL = "gemini-2.5-flash"
+# Persistent answers, so a name is never sent twice for the same candidates
+GEMINI_CACHE_PATH = os.getenv("GEMINI_MATCH_CACHE", "gemini_match_cache.json")
+GEMINI_BATCH_SIZE = 25 # unmatched names per request
+GEMINI_MAX_CANDIDATES = 30 # candidates per name
+GEMINI_WORKERS = 4
+
+_gemini_clients = {}
+_gemini_lock = threading.Lock()
+
+def _get_gemini_client(api_key):
+    """One genai.Client per API key for the whole process."""
+    with _gemini_lock:
+        if api_key not in _gemini_clients:
+            _gemini_clients[api_key] = genai.Client(api_key=api_key)
+        return _gemini_clients[api_key]
+
+class GeminiMatchCache:
+    """
+    JSON file: {nursery_name: {"match": candidate or null, "candidates": fingerprint}}.
+    A cached match is reused while the matched candidate still exists; a cached
+    "no match" is reused while the candidate list is unchanged.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or GEMINI_CACHE_PATH
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+
+    @staticmethod
+    def fingerprint(candidates):
+        return hashlib.sha1("\n".join(sorted(candidates)).encode("utf-8")).hexdigest()
+
+    def get(self, name, candidates):
+        """Return (hit, match)."""
+        entry = self.entries.get(name)
+        if entry is None:
+            return False, None
+        if entry["match"] is not None and entry["match"] in candidates:
+            return True, entry["match"]
+        if entry["match"] is None and entry["candidates"] == self.fingerprint(candidates):
+            return True, None
+        return False, None
+
+    def put(self, name, candidates, match):
+        self.entries[name] = {"match": match, "candidates": self.fingerprint(candidates)}
+
+    def save(self):
+        replace_file(self.path, json.dumps(self.entries, ensure_ascii=False).encode("utf-8"))
+
+def _ask_gemini(client, batch):
+    """
+    One request for a batch of {"name": ..., "candidates": [...]}.
+    Returns {name: match or None}; answers not in the name's candidates are dropped.
     """
-    api_key = os.environ.get("GEMINI_API_KEY")
-    if not api_key:
-        return None
-        
-    client = genai.Client(api_key=api_key)
-    
     prompt = f"""
-    Find the best match for the nursery name '{nursery_name}' from the following list.
-    If no reasonable match exists, return null.
+    For each nursery below, find the best match for its name from its own candidate list.
+    If no reasonable match exists, use null.
     
-    Candidates:
-    {json.dumps(candidates, ensure_ascii=False)}
+    Nurseries:
+    {json.dumps(batch, ensure_ascii=False)}
     
-    Return ONLY a JSON object: {{"match": "candidate_name_or_null"}}
+    Return ONLY a JSON object: {{"matches": [{{"name": "nursery_name", "match": "candidate_name_or_null"}}]}}
     """
-    
-    try:
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt,
-            config=types.GenerateContentConfig(response_mime_type="application/json")
-        )
-        result = json.loads(response.text)
-        return result.get("match")
-    except:
-        return None
-
-def merge_data(nursery_records, bed_records):
+    response = client.models.generate_content(
+        model=GEMINI_MODEL,
+        contents=prompt,
+        config=types.GenerateContentConfig(response_mime_type="application/json")
+    )
+    answers = {}
+    allowed = {item["name"]: set(item["candidates"]) for item in batch}
+    for m in json.loads(response.text).get("matches", []):
+        name, match = m.get("name"), m.get("match")
+        if name in allowed:
+            answers[name] = match if match in allowed[name] else None
+    return answers
+
+def resolve_with_gemini(items, api_key=None, cache=None, errors=None):
+    """
+    Match many nursery names in a few Gemini requests.
+
+    items: list of (nursery_name, [candidate names]), candidates already
+           shortlisted by the caller
+    Returns {nursery_name: matched candidate or None}. Failed batches are
+    reported in `errors` (list) and left unmatched.
+    """
+    api_key = api_key or os.environ.get("GEMINI_API_KEY")
+    if not api_key or not items:
+        return {}
+    cache = cache if cache is not None else GeminiMatchCache()
+
+    results = {}
+    pending = []
+    for name, candidates in items:
+        if not candidates:
+            results[name] = None
+            continue
+        hit, match = cache.get(name, candidates)
+        if hit:
+            results[name] = match
+        else:
+            pending.append({"name": name, "candidates": candidates})
+
+    batches = [pending[i:i + GEMINI_BATCH_SIZE] for i in range(0, len(pending), GEMINI_BATCH_SIZE)]
+    if batches:
+        client = _get_gemini_client(api_key)
+        with ThreadPoolExecutor(max_workers=GEMINI_WORKERS) as pool:
+            futures = [(batch, pool.submit(_ask_gemini, client, batch)) for batch in batches]
+            for batch, future in futures:
+                try:
+                    answers = future.result()
+                except Exception as e:
+                    if errors is not None:
+                        errors.append(f"Gemini照合エラー ({len(batch)}件): {e}")
+                    continue
+                for item in batch:
+                    match = answers.get(item["name"])
+                    results[item["name"]] = match
+                    if item["name"] in answers:
+                        cache.put(item["name"], item["candidates"], match)
+        try:
+            cache.save()
+        except OSError as e:
+            # Answers are still used for this run, only not remembered
+            if errors is not None:
+                errors.append(f"Gemini照合キャッシュ保存エラー: {e}")
+
+    return results
+
+def merge_data(nursery_records, bed_records, use_gemini=False, errors=None, use_fuzzy=True):
     """
     Merge Bed Data into Nursery Data based on ID or Name.
+    Records are kintone_client.KintoneRow (row.get(field) -> value).
+
+    use_fuzzy:  local n-gram matching (fuzzy_matcher) for names left
+                unmatched by the index; only confident matches are taken.
+    use_gemini: send the remaining ambiguous names to Gemini (batched,
+                cached on disk). Problems are appended to `errors`.
     """
     merged = []
     
-    # Build Bed Lookup Dict
-    # Key: Nursery Name (from field "保育園"), Value: Record
-    bed_by_name = {}
-    for r in bed_records:
-        b_name = r.get("保育園", {}).get("value", "")
-        if b_name:
-            bed_by_name[b_name] = r
-    # bed_by_id = {r.get("施設ID", {}).get("value", ""): r for r in bed_records} # If ID exists
+    # Build Bed Lookup Index (once per run)
+    # Key: Nursery Name (from field "保育園") + normalized variants, facility ID if present
+    bed_index = NameIndex(bed_records, "保育園")
     
     for nursery in nursery_records:
         # Changed "施設名" to "name" based on App 218 definition
-        n_name = nursery.get("name", {}).get("value", "")
-        # client_name = nursery.get("client_name", {}).get("value", "")
+        n_name = nursery.get("name", "")
+        # client_name = nursery.get("client_name", "")
+        n_id = nursery.get(FACILITY_ID_FIELD, "") if FACILITY_ID_FIELD in nursery else ""
         
-        # 1. Exact Name Match
-        match = bed_by_name.get(n_name)
-        
-        # 2. Fuzzy Match (Gemini) - Optional pass if critical
-        # if not match and n_name:
-        #    matched_name = get_gemini_match(n_name, list(bed_by_name.keys())[:50]) # Limit candidates
-        #    if matched_name:
-        #        match = bed_by_name.get(matched_name)
+        # 1. Facility ID / Exact / Normalized Name Match
+        match, rule = bed_index.lookup(n_name, n_id)
         
         merged_item = {
             "master": nursery,
-            "bed": match if match else None,
-            "status": "matched" if match else "unmatched"
+            "bed": match if match else None, # list of every joined bed record
+            "status": "matched" if match else "unmatched",
+            "match_rule": rule, # see MATCH_RULES
         }
         merged.append(merged_item)
+    
+    # 2. Fuzzy Match (local n-gram, then Gemini for the ambiguous tail)
+    if use_fuzzy or use_gemini:
+        _apply_fuzzy_matches(merged, bed_records, bed_index, use_fuzzy, use_gemini, errors)
+    
+    # 3. Per-nursery aggregates, so writers never loop over bed records
+    for m in merged:
+        m["bed_total"], m["bed_records"], m["bed_conflict"] = aggregate_beds(m["bed"])
         
     return merged
+
+def _apply_fuzzy_matches(merged, bed_records, bed_index, use_fuzzy=True, use_gemini=False, errors=None):
+    """
+    Fill unmatched merged items.
+    Candidates (all bed app names; the bed app has no area field to block
+    on) are ranked by the n-gram matcher. A name is matched directly only if
+    exactly one candidate and it cover each other almost fully
+    (NgramMatcher.confident_match); the ranked shortlist of the rest goes to
+    Gemini or stays unmatched.
+    """
+    by_name = bed_index.keys["exact"]
+    matcher = fuzzy_matcher.NgramMatcher(sorted(by_name), normalize=lambda n: name_keys(n)["stripped"])
+    top_k = GEMINI_MAX_CANDIDATES if use_gemini else fuzzy_matcher.TOP_K
+
+    def _set_match(m, matched_name, rule):
+        m["bed"] = by_name[matched_name]
+        m["status"] = "matched"
+        m["match_rule"] = rule
+
+    ambiguous = []
+    for m in merged:
+        n_name = m["master"].get("name", "")
+        if m["status"] != "unmatched" or not n_name:
+            continue
+        confident = matcher.confident_match(n_name) if use_fuzzy else None
+        if confident:
+            _set_match(m, confident, "ngram")
+            continue
+        ranked = matcher.match(n_name, top_k=top_k)
+        if use_gemini and ranked:
+            ambiguous.append((m, [c for c, _ in ranked]))
+
+    if not ambiguous:
+        return
+    answers = resolve_with_gemini([(m["master"].get("name", ""), c) for m, c in ambiguous], errors=errors)
+    for m, _ in ambiguous:
+        matched_name = answers.get(m["master"].get("name", ""))
+        if matched_name and matched_name in by_name:
+            _set_match(m, matched_name, "gemini")
@@ -1,6 +1,26 @@
+import io
+import os
+import re
+import pickle
+import hashlib
+import json
+import posixpath
+import threading
+from collections import Counter
+import zipfile
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape, unescape
 import openpyxl
+import pandas as pd
 from copy import copy
 from datetime import datetime
+from openpyxl.styles import Font
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils import get_column_letter
+from openpyxl.formula.tokenizer import Tokenizer, Token
+from openpyxl.formula.translate import Translator, TranslatorError
+
+from file_utils import replace_file
 
 def copy_row_style_and_formulas(ws, source_row_idx, target_row_idx):
     """
@@ -11,13 +31,7 @@ def copy_row_style_and_formulas(ws, source_row_idx, target_row_idx):
         target_cell = ws.cell(row=target_row_idx, column=col)
         
         # Copy Style
-        if source_cell.has_style:
-            target_cell.font = copy(source_cell.font)
-            target_cell.border = copy(source_cell.border)
-            target_cell.fill = copy(source_cell.fill)
-            target_cell.number_format = copy(source_cell.number_format)
-            target_cell.protection = copy(source_cell.protection)
-            target_cell.alignment = copy(source_cell.alignment)
+        copy_cell_style(source_cell, target_cell)
             
         # Copy Formula logic: Simple relative adjustment is hard. 
         # For now, just copy the value or formula string exact.
@@ -56,14 +70,14 @@ def get_column_index(col_letter):
 from copy import copy
 
 def copy_cell_style(source_cell, target_cell):
-    """Copy font, border, fill, number_format, protection, alignment."""
+    """
+    Copy font, border, fill, number_format, protection, alignment.
+    Both cells are in the same workbook, so the source's style ids (already
+    interned in the workbook's style tables) are reused as they are: one
+    assignment, no new style objects, no growth of the saved style table.
+    """
     if source_cell.has_style:
-        target_cell.font = copy(source_cell.font)
-        target_cell.border = copy(source_cell.border)
-        target_cell.fill = copy(source_cell.fill)
-        target_cell.number_format = copy(source_cell.number_format)
-        target_cell.protection = copy(source_cell.protection)
-        target_cell.alignment = copy(source_cell.alignment)
+        target_cell._style = copy(source_cell._style)
 
 def find_header_with_text(ws, text_part):
     """Find cell containing text in first 50 columns, 5 rows."""
@@ -74,82 +88,224 @@ def find_header_with_text(ws, text_part):
                 return ws.cell(row=r, column=c)
     return None
 
-def update_sheet(ws, records, mapping, key_field_kintone="name", key_col_idx=4, start_row=5):
+class FormulaTemplate:
     """
-    Generic update function with Style Copying and Insert Row logic.
+    A formula tokenized once into a row-relative template: literal text plus
+    row numbers stored as offsets from the origin row. instantiate(row) only
+    substitutes the offsets, giving the same result as
+    Translator(formula, origin).translate_formula() for a cell in the same
+    column of that row.
     """
-    # 1. Identify Existing Rows and Last Data Row
-    excel_rows = {}
-    last_data_row = start_row - 1
+
+    def __init__(self, formula, origin_row):
+        self.formula = formula
+        self.origin_row = origin_row
+        tokens = Tokenizer(formula).items
+        if not tokens:
+            self.parts = [""]
+        elif tokens[0].type == Token.LITERAL:
+            self.parts = [tokens[0].value]
+        else:
+            self.parts = ["="]
+            for token in tokens:
+                if token.type == Token.OPERAND and token.subtype == Token.RANGE:
+                    self._compile_range(token.value)
+                else:
+                    self.parts.append(token.value)
+
+    def _row(self, row_str):
+        # Absolute rows stay as text, relative rows become an offset
+        if row_str.startswith("$"):
+            self.parts.append(row_str)
+        else:
+            self.parts.append(int(row_str) - self.origin_row)
+
+    def _compile_range(self, range_str):
+        # Mirrors Translator.translate_range with a column delta of 0
+        ws_part, range_str = Translator.strip_ws_name(range_str)
+        match = Translator.ROW_RANGE_RE.match(range_str) # e.g. `3:4`
+        if match is not None:
+            self.parts.append(ws_part)
+            self._row(match.group(1))
+            self.parts.append(":")
+            self._row(match.group(2))
+            return
+        match = Translator.COL_RANGE_RE.match(range_str) # e.g. `A:BC`
+        if match is not None:
+            self.parts.append(ws_part + Translator.translate_col(match.group(1), 0) + ":"
+                              + Translator.translate_col(match.group(2), 0))
+            return
+        if ":" in range_str: # e.g. `A1:B5`
+            self.parts.append(ws_part)
+            for i, piece in enumerate(range_str.split(":")):
+                if i:
+                    self.parts.append(":")
+                self._compile_range(piece)
+            return
+        match = Translator.CELL_REF_RE.match(range_str)
+        if match is None: # Must be a named range
+            self.parts.append(range_str)
+            return
+        self.parts.append(ws_part + Translator.translate_col(match.group(1), 0))
+        self._row(match.group(2))
+
+    def instantiate(self, row):
+        """Formula for the cell in the same column of row."""
+        out = []
+        for part in self.parts:
+            if isinstance(part, int):
+                new_row = row + part
+                if new_row <= 0:
+                    raise TranslatorError("Formula out of range")
+                out.append(str(new_row))
+            else:
+                out.append(part)
+        return "".join(out)
+
+def insert_row_block(ws, insert_at, count, start_row, errors=None):
+    """
+    Insert count rows at insert_at in one shift (nothing to shift when
+    appending below the last row) and give them the styles and translated
+    formulas of the data row above.
+    Formulas that cannot be translated are copied unchanged and reported in
+    `errors` (list).
+    """
+    if insert_at <= ws.max_row:
+        ws.insert_rows(insert_at, amount=count)
+    
+    # Copy Styles/Formulas from the row above, but never from the HEADER
+    # row (start_row - 1): only an existing sibling data row is a template.
+    source_row = insert_at - 1
+    if source_row < start_row:
+        return
     
-    # Scan from start_row down to find table end
-    MAX_SCAN = 2000
-    for row in range(start_row, MAX_SCAN):
-        cell_val = ws.cell(row=row, column=key_col_idx).value
+    target_rows = range(insert_at, insert_at + count)
+    for col in range(1, ws.max_column + 1):
+        source_cell = ws.cell(row=source_row, column=col)
+        formula = source_cell.value if isinstance(source_cell.value, str) and source_cell.value.startswith("=") else None
+        template = None
+        if formula:
+            try:
+                template = FormulaTemplate(formula, source_row)
+            except Exception as e:
+                if errors is not None:
+                    errors.append(f"数式コピーエラー ({ws.title}!{source_cell.coordinate}): {e}")
+        # Style ids of the source cell, looked up once per column
+        style = source_cell._style if source_cell.has_style else None
         
-        if cell_val:
-            excel_rows[str(cell_val).strip()] = row
-            last_data_row = row
-        else:
-            # Check if next few rows are empty to confirm end
-            # (Checking 3 rows should be enough to avoid false positives in sparse tables)
-            if all(not ws.cell(row=r, column=key_col_idx).value for r in range(row+1, row+4)):
-                break
+        for row in target_rows:
+            target_cell = ws.cell(row=row, column=col)
+            if style is not None:
+                target_cell._style = copy(style)
+            if template:
+                try:
+                    target_cell.value = template.instantiate(row)
+                except TranslatorError as e:
+                    target_cell.value = formula
+                    if errors is not None:
+                        errors.append(f"数式コピーエラー ({ws.title}!{target_cell.coordinate}): {e}")
+            elif formula:
+                target_cell.value = formula
+
+class KeyColumnIndex:
+    """
+    key -> row of one table, read from its key column in one bulk pass.
+    The table ends at the first run of TABLE_END_GAP empty key cells; shorter
+    gaps are skipped. Keys found on several rows are kept in duplicates
+    (the last row wins, as lookups always did).
+    """
+
+    TABLE_END_GAP = 4
+
+    def __init__(self, ws, key_col_idx, start_row):
+        self.rows = {}
+        self.duplicates = {}
+        self.last_row = start_row - 1
+        
+        empty = 0
+        for row, (cell_val,) in enumerate(ws.iter_rows(
+            min_row=start_row, min_col=key_col_idx, max_col=key_col_idx, values_only=True
+        ), start_row):
+            if not cell_val:
+                empty += 1
+                if empty >= self.TABLE_END_GAP:
+                    break
+                continue
+            empty = 0
+            self.add(str(cell_val).strip(), row)
+
+    def get(self, key):
+        return self.rows.get(key)
+
+    def add(self, key, row):
+        if key in self.rows:
+            self.duplicates.setdefault(key, [self.rows[key]]).append(row)
+        self.rows[key] = row
+        self.last_row = max(self.last_row, row)
+
+class WorkbookKeyIndex:
+    """KeyColumnIndex per (sheet, key column, start row) of one workbook, built once."""
+
+    def __init__(self):
+        self.indexes = {}
+
+    def for_sheet(self, ws, key_col_idx, start_row):
+        key = (ws.title, key_col_idx, start_row)
+        if key not in self.indexes:
+            self.indexes[key] = KeyColumnIndex(ws, key_col_idx, start_row)
+        return self.indexes[key]
+
+    def rows_inserted(self, ws, index):
+        """Rows were inserted into ws by index's table: other indexes of ws are stale."""
+        self.indexes = {
+            k: v for k, v in self.indexes.items() if k[0] != ws.title or v is index
+        }
+
+def update_sheet(ws, records, mapping, key_field_kintone="name", key_col_idx=4, start_row=5, config_date=None, key_index=None, errors=None):
+    """
+    Generic update function with Style Copying and Insert Row logic.
+    key_index (WorkbookKeyIndex) shares the key-column scans between calls on
+    the same workbook. Formula copy problems are appended to `errors`.
+    Returns the duplicate keys of the sheet {key: [rows]}.
+    """
+    # 1. Identify Existing Rows and Last Data Row
+    if key_index is None:
+        key_index = WorkbookKeyIndex()
+    index = key_index.for_sheet(ws, key_col_idx, start_row)
             
-    # 2. Process Records
+    # 2. Plan: existing keys are updated in place, new keys get one block of rows
+    targets = []
+    new_keys = []
+    seen_new = set()
     for rec in records:
-        key_val = rec.get(key_field_kintone, {}).get("value", "")
+        key_val = rec.get(key_field_kintone, "")
         if not key_val: continue
-        
-        target_row = excel_rows.get(str(key_val).strip())
-        
-        # [NEW ROW LOGIC]
-        if not target_row:
-            # Insert after the last known data row
-            # Ensure we are at least at start_row
-            insert_at = max(last_data_row + 1, start_row)
-            ws.insert_rows(insert_at)
-            target_row = insert_at
-            
-            # Copy Styles/Formulas from the row above (if it's a valid data row)
-            source_row = insert_at - 1
-            # Only copy if source_row is within our data table range (>= start_row)
-            # OR if it is the template row (start_row) and we are inserting at start_row + 1?
-            # Actually, simply copying from the row above is usually safe in a table.
-            # But we must avoid copying the HEADER row (start_row - 1).
-            # If insert_at == start_row (empty table?), copying start_row-1 might be header.
-            # Safety: If source_row < start_row, maybe don't copy, or warn? 
-            # Assuming template has at least 1 row of data or valid formulas at start_row.
-            
-            if source_row >= start_row or (source_row == start_row - 1 and start_row > 1): 
-                # Allow copying from header row IF user wants style, but formulas might be wrong.
-                # BETTER: Only copy if source_row >= start_row (meaning we copy an existing sibling data row).
-                # If table is empty (last_data_row < start_row), we might have an issue.
-                # Assume template has data.
-                if source_row >= start_row:
-                    for col in range(1, ws.max_column + 1):
-                        source_cell = ws.cell(row=source_row, column=col)
-                        target_cell = ws.cell(row=target_row, column=col)
-                        
-                        copy_cell_style(source_cell, target_cell)
-                        
-                        if isinstance(source_cell.value, str) and source_cell.value.startswith("="):
-                            try:
-                                translated_formula = Translator(source_cell.value, source_cell.coordinate).translate_formula(target_cell.coordinate)
-                                target_cell.value = translated_formula
-                            except:
-                                target_cell.value = source_cell.value
-            
-            # Update our tracker
-            last_data_row = target_row
-            excel_rows[str(key_val).strip()] = target_row
+        key = str(key_val).strip()
+        if index.get(key) is None and key not in seen_new:
+            seen_new.add(key)
+            new_keys.append(key)
+        targets.append((key, rec))
 
-        # [WRITE VALUES]
-        for k_field, col_letter in mapping.items():
-            if col_letter in ["W", "X"]: continue # PROTECTED
-            
-            val = rec.get(k_field, {}).get("value", "")
-            col_idx = get_column_index(col_letter)
+    # [NEW ROW LOGIC]
+    if new_keys:
+        # Insert after the last known data row
+        # Ensure we are at least at start_row
+        insert_at = max(index.last_row + 1, start_row)
+        insert_row_block(ws, insert_at, len(new_keys), start_row, errors)
+        key_index.rows_inserted(ws, index)
+        for offset, key in enumerate(new_keys):
+            index.add(key, insert_at + offset)
+
+    # [WRITE VALUES]
+    columns = [
+        (k_field, get_column_index(col_letter))
+        for k_field, col_letter in mapping.items()
+        if col_letter not in ["W", "X"] # PROTECTED
+    ]
+    for key, rec in targets:
+        target_row = index.get(key)
+        for k_field, col_idx in columns:
+            val = rec.get(k_field, "")
             
             # Type Conversion
             if "日" in k_field and val:
@@ -168,7 +324,7 @@ def update_sheet(ws, records, mapping, key_field_kintone="name", key_col_idx=4,
 
     # 3. Update Date Header (Once per sheet if relevant)
     # Search for "現在" in top rows
-    date_cell = find_header_with_text(ws, "現在")
+    date_cell = find_header_with_text(ws, "現在") if config_date else None
     if date_cell:
          # Replace date part logic? Or just overwrite "20xx年x月 現在"
          # Assuming user wants "YYYY年M月xD日 現在" or similar
@@ -176,6 +332,8 @@ def update_sheet(ws, records, mapping, key_field_kintone="name", key_col_idx=4,
          new_str = config_date.strftime("%Y年%m月 現在") # Guessing format from manual
          date_cell.value = new_str
 
+    return index.duplicates
+
 
             
 
@@ -192,7 +350,6 @@ def update_excel(template_file, merged_data, config_date):
     
     sheet_names = wb.sheetnames
     
-from openpyxl.formula.translate import Translator
 
 # Sheet 1: クライアント名あり（縦）
 # This is the presentation sheet.
@@ -205,122 +362,730 @@ CLIENT_VIEW_MAP = {
 }
 CLIENT_VIEW_KEY_COL = 28 # Column AB
 
-def update_excel(template_file, merged_data, config_date):
+# Sheet: Kintoneデータ抽出 (first sheet, clean summary list)
+EXTRACT_SHEET_NAME = "Kintoneデータ抽出"
+EXTRACT_HEADERS = [
+    "住所", "ステータス", "施設名", "クライアント名", "開園日", "基本開園日", "定員", 
+    "病児保育", "学童", "夜間保育", 
+    "施設形態", "施設区分", "病床数"
+]
+# Header -> App 218 field code (住所 and 病床数 are derived)
+EXTRACT_FIELDS = {
+    "ステータス": "status",
+    "施設名": "name",
+    "クライアント名": "client_name",
+    "開園日": "open_date",
+    "基本開園日": "基本開園日",
+    "定員": "capacity",
+    "病児保育": "sick_child_care",
+    "学童": "sc_flg",
+    "夜間保育": "night_care",
+    "施設形態": "ekbn2",
+    "施設区分": "ekbn4",
+}
+# Checkbox fields (lists), written as "a, b"
+EXTRACT_LIST_COLUMNS = ["基本開園日", "病児保育", "学童", "夜間保育", "施設形態", "施設区分"]
+
+# Sort logic: North to South (JIS X 0401)
+PREFECTURES = [
+    "北海道", "青森県", "岩手県", "宮城県", "秋田県", "山形県", "福島県",
+    "茨城県", "栃木県", "群馬県", "埼玉県", "千葉県", "東京都", "神奈川県",
+    "新潟県", "富山県", "石川県", "福井県", "山梨県", "長野県", "岐阜県",
+    "静岡県", "愛知県", "三重県", "滋賀県", "京都府", "大阪府", "兵庫県",
+    "奈良県", "和歌山県", "鳥取県", "島根県", "岡山県", "広島県", "山口県",
+    "徳島県", "香川県", "愛媛県", "高知県", "福岡県", "佐賀県", "長崎県",
+    "熊本県", "大分県", "宮崎県", "鹿児島県", "沖縄県"
+]
+
+def _join_list(v):
+    if isinstance(v, (list, tuple)): return ", ".join(v)
+    return v
+
+def build_extract_frame(merged_data):
+    """
+    Turn merged_data into the rows of the Kintoneデータ抽出 sheet, as a DataFrame
+    with EXTRACT_HEADERS columns, sorted by prefecture (JIS order), city, client.
+    The frame index is the position of each row in merged_data.
+    """
+    masters = [item['master'] for item in merged_data]
+    
+    # One pass per column
+    columns = {
+        header: [m.get(field, "") for m in masters]
+        for header, field in EXTRACT_FIELDS.items()
+    }
+    df = pd.DataFrame(columns, dtype=object)
+    area = pd.Series([m.get('addr_area', "") or "" for m in masters], dtype=object)
+    city = pd.Series([m.get('addr_city', "") or "" for m in masters], dtype=object)
+    
+    # Col 1: Address (addr_area + addr_city)
+    df.insert(0, "住所", area + city)
+    # Bed count, pre-aggregated by merge_data; object so int totals stay ints
+    # next to fractional ones (6, not 6.0)
+    df["病床数"] = pd.Series([item.get('bed_total', 0) for item in merged_data], dtype=object)
+    for col in EXTRACT_LIST_COLUMNS:
+        df[col] = df[col].map(_join_list)
+    
+    # Prefecture as an ordered categorical (unknown -> NaN -> last),
+    # then city and client name
+    sort_keys = pd.DataFrame({
+        "pref": pd.Categorical(area, categories=PREFECTURES, ordered=True),
+        "city": city,
+        "client": df["クライアント名"].fillna("").astype(str),
+    })
+    order = sort_keys.sort_values(["pref", "city", "client"], na_position="last", kind="stable").index
+    return df.loc[order, EXTRACT_HEADERS]
+
+def extract_sheet_rows(merged_data, config_date=None):
+    """
+    Rows of the Kintoneデータ抽出 sheet, header first (with the date for N1
+    when config_date is given). Sorts merged_data in place to the row order.
+    """
+    # Sorted, formatted rows in one columnar pass
+    frame = build_extract_frame(merged_data)
+    merged_data[:] = [merged_data[i] for i in frame.index]
+    header = list(EXTRACT_HEADERS)
+    if config_date is not None:
+        header.append(config_date.strftime("%Y/%m/%d"))
+    return [header] + [list(r) for r in frame.itertuples(index=False, name=None)]
+
+# --- Change tracking ---
+# Fingerprint of a generated extract sheet: a hash per row (by position) and
+# per field of each facility (by 施設名), enough to diff the next run
+# without keeping the previous file.
+FINGERPRINT_FORMAT = 1
+EXTRACT_KEY_COLUMN = EXTRACT_HEADERS.index("施設名")
+
+def _cell_text(value):
+    return "" if value is None else str(value)
+
+def _digest(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+def _sheet_values(ws):
+    """Extract sheet rows of a worksheet, trailing empty rows dropped."""
+    rows = [list(r) for r in ws.iter_rows(min_row=1, max_col=len(EXTRACT_HEADERS), values_only=True)]
+    while rows and all(v in (None, "") for v in rows[-1]):
+        rows.pop()
+    return rows
+
+def _facility_keys(rows):
+    """施設名 of each data row; repeated names become "name#2", "name#3", ..."""
+    seen = Counter()
+    keys = []
+    for row in rows:
+        name = _cell_text(row[EXTRACT_KEY_COLUMN] if len(row) > EXTRACT_KEY_COLUMN else "")
+        seen[name] += 1
+        keys.append(name if seen[name] == 1 else f"{name}#{seen[name]}")
+    return keys
+
+def extract_fingerprint(sheet_rows, template_sha=None, workbook_sha=None):
+    """
+    Fingerprint (JSON-serializable dict) of the rows of an extract sheet.
+    template_sha / workbook_sha record the template it was generated from
+    and the sha256 of the stored workbook it describes.
+    """
+    width = len(EXTRACT_HEADERS)
+    sheet_rows = list(sheet_rows)
+    while sheet_rows and all(v in (None, "") for v in sheet_rows[-1][:width]):
+        sheet_rows.pop()
+    cells = [[_cell_text(v) for v in list(row[:width]) + [None] * (width - len(row[:width]))] for row in sheet_rows]
+    return {
+        "format": FINGERPRINT_FORMAT,
+        "template": template_sha,
+        "workbook": workbook_sha,
+        "rows": [_digest("\x1f".join(row)) for row in cells],
+        "facilities": {
+            key: [_digest(v) for v in row]
+            for key, row in zip(_facility_keys(sheet_rows[1:]), cells[1:])
+        },
+    }
+
+def diff_extract(previous_fp, sheet_rows):
+    """
+    Compare new extract sheet rows with a previous fingerprint.
+    Returns (summary, changed_rows): summary is {"added": [names],
+    "removed": [names], "changed": {name: [headers]}}, changed_rows the
+    1-based sheet rows whose content differs at that position.
+    """
+    current = extract_fingerprint(sheet_rows)
+    old_rows = previous_fp.get("rows", [])
+    changed_rows = {
+        idx for idx, digest in enumerate(current["rows"], 1)
+        if idx > len(old_rows) or old_rows[idx - 1] != digest
+    }
+    
+    old = previous_fp.get("facilities", {})
+    new = current["facilities"]
+    changed = {}
+    for key, digests in new.items():
+        if key in old and old[key] != digests:
+            changed[key] = [h for h, a, b in zip(EXTRACT_HEADERS, old[key], digests) if a != b]
+    summary = {
+        "added": [key for key in new if key not in old],
+        "removed": [key for key in old if key not in new],
+        "changed": changed,
+    }
+    return summary, changed_rows
+
+def _previous_rows(previous):
+    """Extract sheet rows of a previously generated workbook (path or file object)."""
+    wb = openpyxl.load_workbook(previous, read_only=True)
+    try:
+        return _sheet_values(wb.worksheets[0])
+    finally:
+        wb.close()
+
+def update_excel(template_file, merged_data, config_date, previous=None, changes=None):
     """
     Update the first sheet of the workbook with a clean summary list.
+    
+    previous: the previously generated workbook (path or file object) or its
+    extract_fingerprint(). A previous workbook is updated in place and only
+    rows whose content changed are rewritten. With either form, `changes`
+    (dict) receives the change summary of diff_extract().
     """
-    wb = openpyxl.load_workbook(template_file, keep_vba=True)
+    sheet_rows = extract_sheet_rows(merged_data)
+    
+    prev_wb = None
+    prev_fp = previous if isinstance(previous, dict) else None
+    if previous is not None and prev_fp is None:
+        prev_wb = openpyxl.load_workbook(previous, keep_vba=True)
+        prev_fp = extract_fingerprint(_sheet_values(prev_wb.worksheets[0]))
+    
+    rows_to_write = range(1, len(sheet_rows) + 1)
+    if prev_fp is not None:
+        summary, changed_rows = diff_extract(prev_fp, sheet_rows)
+        if changes is not None:
+            changes.update(summary)
+        if prev_wb is not None:
+            rows_to_write = sorted(changed_rows)
+    
+    # Parsed once per process, each call gets its own copy
+    wb = prev_wb or load_template(template_file)
     
     # Target: First Sheet
     ws = wb.worksheets[0]
-    ws.title = "Kintoneデータ抽出"
+    ws.title = EXTRACT_SHEET_NAME
     
     # Clear existing data (keep row 1 if valuable? No, user wants specific headers)
     # Let's overwrite from A1
+    if prev_wb is not None and ws.max_row > len(sheet_rows):
+        ws.delete_rows(len(sheet_rows) + 1, ws.max_row - len(sheet_rows))
     
-    # 1. Define Headers
-    headers = [
-        "住所", "ステータス", "施設名", "クライアント名", "開園日", "基本開園日", "定員", 
-        "病児保育", "学童", "夜間保育", 
-        "施設形態", "施設区分", "病床数"
-    ]
+    for row_idx in rows_to_write:
+        for col_idx, value in enumerate(sheet_rows[row_idx - 1], 1):
+            cell = ws.cell(row=row_idx, column=col_idx)
+            cell.value = value
+            # 1. Headers: Make header bold
+            if row_idx == 1:
+                cell.font = Font(bold=True)
+
+    return wb
+
+# --- Streaming output ---
+# The extract sheet is the only part of the template that changes, so the
+# workbook can be produced by copying every other zip entry as-is (VBA,
+# styles, drawings, the other sheets) and writing the new sheet XML row by row.
+_NS_MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_NS_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_NS_PKG_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+_CELL_STYLE_RE = re.compile(r'<c r="([A-Z]+)1"[^>]*?\ss="(\d+)"')
+
+def _sheet_part(zin, sheet_name):
+    """Zip path of the worksheet XML for sheet_name."""
+    wb_xml = ET.fromstring(zin.read("xl/workbook.xml"))
+    rels = ET.fromstring(zin.read("xl/_rels/workbook.xml.rels"))
+    for sheet in wb_xml.iter(f"{_NS_MAIN}sheet"):
+        if sheet.get("name") == sheet_name:
+            rid = sheet.get(f"{_NS_REL}id")
+            break
+    else:
+        raise Exception(f"Sheet not found in template: {sheet_name}")
+    for rel in rels.iter(f"{_NS_PKG_REL}Relationship"):
+        if rel.get("Id") == rid:
+            target = rel.get("Target")
+            return target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+    raise Exception(f"Sheet part not found in template: {sheet_name}")
+
+def _cell_xml(ref, value, style=None):
+    s = f' s="{style}"' if style else ""
+    if value is None or value == "":
+        return f'<c r="{ref}"{s}/>' if style else ""
+    if isinstance(value, bool):
+        return f'<c r="{ref}"{s} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c r="{ref}"{s}><v>{value}</v></c>'
+    text = ILLEGAL_CHARACTERS_RE.sub("", str(value))
+    space = ' xml:space="preserve"' if text != text.strip() else ""
+    return f'<c r="{ref}"{s} t="inlineStr"><is><t{space}>{escape(text)}</t></is></c>'
+
+def _row_xml(row_idx, values, styles=()):
+    cells = "".join(
+        _cell_xml(f"{letter}{row_idx}", value, style)
+        for letter, value, style in zip(_COLUMN_LETTERS, values, styles or [None] * len(values))
+    )
+    return f'<row r="{row_idx}">{cells}</row>'
+
+_COLUMN_LETTERS = [get_column_letter(i) for i in range(1, 64)]
+
+def write_excel_streaming(template_file, merged_data, config_date, output, previous=None, changes=None, fingerprint=None):
+    """
+    Streaming counterpart of update_excel: writes the finished workbook
+    (template + Kintoneデータ抽出 sheet + date in N1) to output without
+    loading the template into openpyxl.
     
-    # Write Headers
-    for col_idx, header in enumerate(headers, 1):
-        cell = ws.cell(row=1, column=col_idx)
-        cell.value = header
-        # Optional: Make header bold
-        from openpyxl.styles import Font
-        cell.font = Font(bold=True)
-
-    # Sort logic: North to South (JIS X 0401)
-    prefectures = [
-        "北海道", "青森県", "岩手県", "宮城県", "秋田県", "山形県", "福島県",
-        "茨城県", "栃木県", "群馬県", "埼玉県", "千葉県", "東京都", "神奈川県",
-        "新潟県", "富山県", "石川県", "福井県", "山梨県", "長野県", "岐阜県",
-        "静岡県", "愛知県", "三重県", "滋賀県", "京都府", "大阪府", "兵庫県",
-        "奈良県", "和歌山県", "鳥取県", "島根県", "岡山県", "広島県", "山口県",
-        "徳島県", "香川県", "愛媛県", "高知県", "福岡県", "佐賀県", "長崎県",
-        "熊本県", "大分県", "宮崎県", "鹿児島県", "沖縄県"
-    ]
+    output is a path or a writable binary file object. Returns the rows of
+    the extract sheet (header first), as they were written.
+    previous/changes as in update_excel; the sheet is always written whole.
+    The stored fingerprint of previous, if given, saves reading it.
+    """
+    # Same layout as update_excel + the page's N1 stamp
+    sheet_rows = extract_sheet_rows(merged_data, config_date)
+    header = sheet_rows[0]
+    if previous is not None and changes is not None:
+        prev_fp = previous if isinstance(previous, dict) else fingerprint or extract_fingerprint(_previous_rows(previous))
+        changes.update(diff_extract(prev_fp, sheet_rows)[0])
     
-    # Create a rank map for faster lookup
-    pref_rank = {p: i for i, p in enumerate(prefectures)}
+    parts = _template_cache.parts(template_file)
+    part, head, tail = parts["part"], parts["head"], parts["tail"]
+    styles = [parts["header_styles"].get(letter) for letter in _COLUMN_LETTERS[:len(header)]]
     
-    def get_sort_key(item):
-        # Master record
-        mas = item.get('master', {})
-        
-        # 1. Prefecture Rank
-        # Extract addr_area directly
-        addr = mas.get('addr_area', {}).get('value', "")
-        rank = pref_rank.get(addr, 999)
-        
-        # 2. Municipality (City/Ward)
-        city = mas.get('addr_city', {}).get('value', "") or ""
-        
-        # 3. Client Name
-        client = mas.get('client_name', {}).get('value', "") or ""
+    last_ref = f"{_COLUMN_LETTERS[len(header) - 1]}{len(sheet_rows)}"
+    head = re.sub(r'<dimension ref="[^"]*"/>', f'<dimension ref="A1:{last_ref}"/>', head)
+    
+    with zipfile.ZipFile(io.BytesIO(parts["data"])) as zin, zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zout:
+        for info in zin.infolist():
+            if info.filename == part:
+                with zout.open(info.filename, "w") as f:
+                    f.write(head.encode("utf-8"))
+                    f.write(b"<sheetData>")
+                    f.write(_row_xml(1, header, styles).encode("utf-8"))
+                    for row_idx, row in enumerate(sheet_rows[1:], 2):
+                        f.write(_row_xml(row_idx, row).encode("utf-8"))
+                    f.write(b"</sheetData>")
+                    f.write(tail.encode("utf-8"))
+            elif info.filename == "xl/workbook.xml":
+                zout.writestr(info, parts["workbook_xml"])
+            else:
+                _copy_part(zin, zout, info)
+    
+    return sheet_rows
+
+# --- Template cache ---
+class TemplateCache:
+    """
+    Process-wide cache of parsed templates (sample.xlsm), shared by all
+    sessions of the app.
+    
+    The template is parsed once; each caller gets an isolated copy
+    (unpickled from a snapshot for openpyxl, immutable template bytes for
+    the streaming writer). A changed mtime/size triggers a hash check, and a
+    changed hash a re-parse.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {} # abs path -> {"stat", "sha", "data", "workbook", "parts"}
+
+    def _entry(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stat = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry["stat"] == stat:
+                return entry
+            with open(path, "rb") as f:
+                data = f.read()
+            sha = hashlib.sha256(data).hexdigest()
+            if entry is not None and entry["sha"] == sha:
+                # Touched but not changed
+                entry["stat"] = stat
+                return entry
+            entry = {"stat": stat, "sha": sha, "data": data, "workbook": None, "parts": None}
+            self.entries[path] = entry
+            return entry
+
+    def workbook(self, path):
+        """A fresh openpyxl Workbook of the template (keep_vba)."""
+        entry = self._entry(path)
+        with self.lock:
+            if entry["workbook"] is None:
+                wb = openpyxl.load_workbook(io.BytesIO(entry["data"]), keep_vba=True)
+                # The VBA archive is an open ZipFile; it is reattached per copy
+                has_vba = wb.vba_archive is not None
+                wb.vba_archive = None
+                entry["workbook"] = (pickle.dumps(wb, protocol=pickle.HIGHEST_PROTOCOL), has_vba)
+            snapshot, has_vba = entry["workbook"]
+        wb = pickle.loads(snapshot)
+        if has_vba:
+            wb.vba_archive = zipfile.ZipFile(io.BytesIO(entry["data"]))
+        return wb
+
+    def parts(self, path):
+        """Template bytes and the split extract sheet XML, for write_excel_streaming."""
+        entry = self._entry(path)
+        with self.lock:
+            if entry["parts"] is None:
+                entry["parts"] = _read_template_parts(entry["data"])
+            return entry["parts"]
+
+    def data(self, path):
+        """Raw bytes of the template file."""
+        return self._entry(path)["data"]
+
+    def sha(self, path):
+        """sha256 of the template file."""
+        return self._entry(path)["sha"]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+def _read_template_parts(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as zin:
+        part = _sheet_part(zin, EXTRACT_SHEET_NAME)
+        sheet_xml = zin.read(part).decode("utf-8")
+        head, rest = re.split(r"<sheetData\s*/>|<sheetData>", sheet_xml, maxsplit=1)
+        tail = rest.split("</sheetData>", 1)[1] if "</sheetData>" in rest else rest
         
-        return (rank, city, client)
+        # Cached values of the other sheets' formulas are stale after the extract sheet is rewritten
+        wb_xml = zin.read("xl/workbook.xml").decode("utf-8")
+        if "fullCalcOnLoad" not in wb_xml:
+            wb_xml = re.sub(r"<calcPr\b", '<calcPr fullCalcOnLoad="1"', wb_xml, count=1)
+    
+    return {
+        "part": part,
+        "head": head,
+        "tail": tail,
+        # Keep the template's header cell styles (row 1)
+        "header_styles": dict(_CELL_STYLE_RE.findall(rest.split("</row>", 1)[0])),
+        "workbook_xml": wb_xml.encode("utf-8"),
+        # Other parts are copied from here unchanged
+        "data": data,
+    }
+
+_template_cache = TemplateCache()
 
-    # Sort merged_data in place with multi-key
-    merged_data.sort(key=get_sort_key)
+def load_template(path):
+    """Isolated openpyxl copy of the template at path, parsed once per process."""
+    return _template_cache.workbook(path)
 
-    # 2. Write Data
-    # merged_data list of dicts: {'master': {...}, 'bed': {...}}
+# --- OOXML patching ---
+# Rewrites selected rows of one worksheet inside an existing .xlsx/.xlsm.
+# The sheet XML is scanned row by row; untouched rows are copied as text,
+# new strings are appended to the shared strings table, and every other
+# part (vbaProject.bin, drawings, other sheets) is copied unchanged.
+_ROW_START_RE = re.compile(r"<row\b[^>]*?(/?)>")
+_ROW_NUM_RE = re.compile(r'\sr="(\d+)"')
+_ROW_ATTR_DROP_RE = re.compile(r'\s(?:r|spans)="[^"]*"')
+_ANY_CELL_STYLE_RE = re.compile(r'<c r="([A-Z]+)\d+"[^>]*?\ss="(\d+)"')
+_DIMENSION_RE = re.compile(r'<dimension ref="[A-Z]*\d*:?([A-Z]*)(\d*)"/>')
+_SI_RE = re.compile(r"<si>(.*?)</si>|<si/>", re.S)
+_T_RE = re.compile(r"<t\b[^>]*?(?:/>|>(.*?)</t>)", re.S)
+_RPH_RE = re.compile(r"<rPh\b.*?</rPh>", re.S)
+_CALC_CELL_RE = re.compile(r"<c\b([^>]*?)/>")
+_CONTENT_TYPES = "[Content_Types].xml"
+_READ_CHUNK = 1 << 16
+
+def _copy_part(zin, zout, info):
+    """Copy one zip entry unchanged (identical content after decompression)."""
+    zout.writestr(info, zin.read(info.filename))
+
+class SharedStrings:
+    """
+    The shared strings table of a workbook: existing <si> entries are kept
+    verbatim (rich text, phonetic runs), new strings are appended.
+    """
+
+    def __init__(self, xml=None):
+        self.head = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        self.items = []
+        self.index = {}
+        self.added = []
+        if xml is None:
+            return
+        start = xml.index("<sst")
+        head_end = xml.index(">", start)
+        self.head = xml[:head_end + 1]
+        if self.head.endswith("/>"):
+            self.head = self.head[:-2] + ">"
+            return
+        for m in _SI_RE.finditer(xml, head_end):
+            self.items.append(m.group(0))
+            body = _RPH_RE.sub("", m.group(1) or "")
+            text = unescape("".join(t or "" for t in _T_RE.findall(body)))
+            self.index.setdefault(text, len(self.items) - 1)
+
+    def get(self, text):
+        """Index of text, appending it if new."""
+        idx = self.index.get(text)
+        if idx is None:
+            idx = len(self.items)
+            space = ' xml:space="preserve"' if text != text.strip() else ""
+            self.items.append(f"<si><t{space}>{escape(text)}</t></si>")
+            self.index[text] = idx
+            self.added.append(text)
+        return idx
+
+    def to_xml(self):
+        head = re.sub(r'\s(?:count|uniqueCount)="\d*"', "", self.head)
+        head = head[:-1] + f' count="{len(self.items)}" uniqueCount="{len(self.items)}">'
+        return head + "".join(self.items) + "</sst>"
+
+def _patched_cell_xml(ref, value, style, sst):
+    if sst is None or not isinstance(value, str) or value == "":
+        return _cell_xml(ref, value, style)
+    s = f' s="{style}"' if style else ""
+    return f'<c r="{ref}"{s} t="s"><v>{sst.get(ILLEGAL_CHARACTERS_RE.sub("", value))}</v></c>'
+
+def _patched_row_xml(row_idx, values, old_xml, sst, styles=None):
+    """New XML of one row; keeps the old row's attributes and cell styles."""
+    attrs = ""
+    old_styles = {}
+    if old_xml:
+        start = _ROW_START_RE.match(old_xml)
+        attrs = _ROW_ATTR_DROP_RE.sub("", old_xml[4:start.end() - 1 - len(start.group(1))])
+        old_styles = dict(_ANY_CELL_STYLE_RE.findall(old_xml))
+    cells = []
+    for letter, value in zip(_COLUMN_LETTERS, values):
+        style = styles.get(letter) if styles else old_styles.get(letter)
+        cells.append(_patched_cell_xml(f"{letter}{row_idx}", value, style, sst))
+    return f'<row r="{row_idx}"{attrs}>{"".join(cells)}</row>'
+
+def _iter_sheet_xml(stream):
+    """
+    Scan worksheet XML from a text stream, yielding ("head", text),
+    ("row", row_number, text) for each <row>, and ("tail", text).
+    Reads fixed-size chunks; only the current row is held in memory.
+    """
+    buf = ""
+    while "<sheetData" not in buf or ">" not in buf[buf.index("<sheetData"):]:
+        chunk = stream.read(_READ_CHUNK)
+        if not chunk:
+            raise Exception("Worksheet XML without sheetData")
+        buf += chunk
+    start = buf.index("<sheetData")
+    end = buf.index(">", start)
+    if buf[end - 1] == "/": # <sheetData/>
+        yield ("head", buf[:start])
+        yield ("tail", buf[end + 1:] + stream.read())
+        return
+    yield ("head", buf[:start])
+    buf = buf[end + 1:]
     
-    row_idx = 2
-    for i, item in enumerate(merged_data, 1):
-        m = item.get('master', {})
-        b = item.get('bed', {}) # Bed data might be array or single? Assuming 1-to-1 match logic from merge_data
-        
-        # Helper to safely get value
-        def val(record, field):
-            return record.get(field, {}).get('value', "")
-
-        # Write Row
-        # Col 1: Address (addr_area + addr_city)
-        address = f"{val(m, 'addr_area')}{val(m, 'addr_city')}"
-        ws.cell(row=row_idx, column=1).value = address
-        
-        ws.cell(row=row_idx, column=2).value = val(m, 'status')
-        ws.cell(row=row_idx, column=3).value = val(m, 'name')
-        ws.cell(row=row_idx, column=4).value = val(m, 'client_name')
-        ws.cell(row=row_idx, column=5).value = val(m, 'open_date')
+    while True:
+        m = _ROW_START_RE.search(buf)
+        close = buf.find("</sheetData>")
+        if close != -1 and (m is None or close < m.start()):
+            yield ("tail", buf[close + len("</sheetData>"):] + stream.read())
+            return
+        if m is not None:
+            row_end = m.end() if m.group(1) else buf.find("</row>", m.end())
+            if row_end != -1:
+                if not m.group(1):
+                    row_end += len("</row>")
+                yield ("row", int(_ROW_NUM_RE.search(m.group(0)).group(1)), buf[m.start():row_end])
+                buf = buf[row_end:]
+                continue
+        chunk = stream.read(_READ_CHUNK)
+        if not chunk:
+            raise Exception("Worksheet XML ended inside sheetData")
+        buf += chunk
+
+def _drop_calc_chain_sheet(xml, sheet_pos):
+    """Remove calcChain entries of one sheet (1-based position); Excel rebuilds them."""
+    current = None
+    dropped = 0
+    def keep(m):
+        nonlocal current, dropped
+        attrs = m.group(1)
+        i = re.search(r'\si="(\d+)"', attrs)
+        if i:
+            current = int(i.group(1))
+        elif current is None:
+            current = 1
+        if current == sheet_pos:
+            dropped += 1
+            return ""
+        # Entries inherit i from the previous one, so spell it out
+        attrs = re.sub(r'\si="\d+"', "", attrs)
+        return f'<c{attrs} i="{current}"/>'
+    patched = _CALC_CELL_RE.sub(keep, xml)
+    return patched if dropped else xml
+
+def _without_calc_chain_part(zin, name):
+    """Content of the parts that reference calcChain.xml, with the reference removed."""
+    data = zin.read(name).decode("utf-8")
+    if name == _CONTENT_TYPES:
+        return re.sub(r'<Override PartName="/xl/calcChain.xml"[^>]*/>', "", data)
+    return re.sub(r'<Relationship [^>]*Target="calcChain.xml"[^>]*/>', "", data)
+
+def patch_sheet_rows(source, output, sheet_name, rows, last_row=None, row_styles=None):
+    """
+    Copy the workbook source to output with rows of sheet_name replaced.
+    
+    rows: {row number: [values from column A]}; each given row is rebuilt
+          (keeping its row attributes and cell styles), other rows are
+          copied unchanged. Rows not in the sheet yet are added in order.
+    last_row: rows below it are removed.
+    row_styles: {row number: {column letter: style id}} to override styles.
+    
+    Strings go to the shared strings table when the workbook has one.
+    Values only: calcChain entries of the patched sheet are dropped and
+    workbook.xml gets fullCalcOnLoad, so Excel recalculates on open.
+    """
+    row_styles = row_styles or {}
+    with zipfile.ZipFile(source) as zin:
+        names = set(zin.namelist())
+        part = _sheet_part(zin, sheet_name)
+        sst_name = "xl/sharedStrings.xml" if "xl/sharedStrings.xml" in names else None
+        sst = SharedStrings(zin.read(sst_name).decode("utf-8")) if sst_name else None
         
-        # Checkbox for Basic Opening Days (likely a list)
-        def fmt(v):
-            if isinstance(v, list): return ", ".join(v)
-            return v
-            
-        ws.cell(row=row_idx, column=6).value = fmt(val(m, '基本開園日'))
-        ws.cell(row=row_idx, column=7).value = val(m, 'capacity')
+        wb_xml = zin.read("xl/workbook.xml").decode("utf-8")
+        sheet_names = [s.get("name") for s in ET.fromstring(wb_xml.encode("utf-8")).iter(f"{_NS_MAIN}sheet")]
+        sheet_pos = sheet_names.index(sheet_name) + 1
         
-        ws.cell(row=row_idx, column=8).value = fmt(val(m, 'sick_child_care'))
-        ws.cell(row=row_idx, column=9).value = fmt(val(m, 'sc_flg'))
-        ws.cell(row=row_idx, column=10).value = fmt(val(m, 'night_care'))
-        ws.cell(row=row_idx, column=11).value = fmt(val(m, 'ekbn2'))
-        ws.cell(row=row_idx, column=12).value = fmt(val(m, 'ekbn4'))
+        calc_name = "xl/calcChain.xml" if "xl/calcChain.xml" in names else None
+        calc_xml = None
+        if calc_name:
+            original = zin.read(calc_name).decode("utf-8")
+            calc_xml = _drop_calc_chain_sheet(original, sheet_pos)
+            if calc_xml == original:
+                calc_name = None # nothing of this sheet in it: copied as-is
+            elif not _CALC_CELL_RE.search(calc_xml):
+                calc_xml = None # empty chain: remove the part altogether
         
-        # Bed count from bed app
-        # bed_data is likely a list of records if multiple matched? 
-        # Checking merge_data logic (not visible here but assuming structure)
-        # Usually merge_data returns 'bed' as list of records matching the name.
-        # Let's sum bed counts if multiple?
-        bed_count = 0
-        if isinstance(b, list):
-            for brec in b:
-                try:
-                    bed_count += int(brec.get('病床数合計_0', {}).get('value', 0) or 0)
-                except: pass
-        elif isinstance(b, dict):
-             try:
-                bed_count = int(b.get('病床数合計_0', {}).get('value', 0) or 0)
-             except: pass
-             
-        ws.cell(row=row_idx, column=13).value = bed_count
+        if "fullCalcOnLoad" not in wb_xml:
+            wb_xml = re.sub(r"<calcPr\b", '<calcPr fullCalcOnLoad="1"', wb_xml, count=1)
         
-        row_idx += 1
+        pending = sorted(rows)
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zout:
+            for info in zin.infolist():
+                name = info.filename
+                if name == part:
+                    stream = io.TextIOWrapper(zin.open(name), encoding="utf-8")
+                    with zout.open(name, "w") as f:
+                        pos = 0
+                        for event in _iter_sheet_xml(stream):
+                            if event[0] == "head":
+                                head = event[1]
+                                dim = _DIMENSION_RE.search(head)
+                                width = max([len(v) for v in rows.values()] + [1])
+                                if dim and dim.group(1):
+                                    width = max(width, openpyxl.utils.column_index_from_string(dim.group(1)))
+                                height = max(pending + [int(dim.group(2)) if dim and dim.group(2) else 1])
+                                if last_row is not None:
+                                    height = min(height, max(last_row, 1))
+                                head = _DIMENSION_RE.sub(f'<dimension ref="A1:{_COLUMN_LETTERS[width - 1]}{height}"/>', head)
+                                f.write(head.encode("utf-8") + b"<sheetData>")
+                            elif event[0] == "row":
+                                _, row_idx, xml = event
+                                # New rows that come before this one
+                                while pos < len(pending) and pending[pos] < row_idx:
+                                    r = pending[pos]
+                                    f.write(_patched_row_xml(r, rows[r], None, sst, row_styles.get(r)).encode("utf-8"))
+                                    pos += 1
+                                if pos < len(pending) and pending[pos] == row_idx:
+                                    xml = _patched_row_xml(row_idx, rows[row_idx], xml, sst, row_styles.get(row_idx))
+                                    pos += 1
+                                elif last_row is not None and row_idx > last_row:
+                                    continue
+                                f.write(xml.encode("utf-8"))
+                            else:
+                                for r in pending[pos:]:
+                                    f.write(_patched_row_xml(r, rows[r], None, sst, row_styles.get(r)).encode("utf-8"))
+                                f.write(b"</sheetData>" + event[1].encode("utf-8"))
+                elif name == sst_name:
+                    zout.writestr(info, sst.to_xml().encode("utf-8"))
+                elif name == "xl/workbook.xml":
+                    zout.writestr(info, wb_xml.encode("utf-8"))
+                elif name == calc_name:
+                    if calc_xml is not None:
+                        zout.writestr(info, calc_xml.encode("utf-8"))
+                elif calc_name and calc_xml is None and name in (_CONTENT_TYPES, "xl/_rels/workbook.xml.rels"):
+                    zout.writestr(info, _without_calc_chain_part(zin, name).encode("utf-8"))
+                else:
+                    _copy_part(zin, zout, info)
+    
+    return sst.added if sst else []
 
-    return wb
+
+def write_excel_patch(template_file, merged_data, config_date, output, previous=None, changes=None, fingerprint=None):
+    """
+    Patch-mode counterpart of write_excel_streaming: the extract sheet rows
+    of the template are replaced in place (row attributes and cell styles
+    kept, strings shared), leftover template rows removed, and every other
+    part copied unchanged. Returns the rows of the sheet.
+    
+    previous/changes as in update_excel. A previous workbook is patched
+    instead of the template, rewriting only the rows that changed; its
+    stored fingerprint, if given, saves reading it.
+    """
+    sheet_rows = extract_sheet_rows(merged_data, config_date)
+    rows = {row_idx: values for row_idx, values in enumerate(sheet_rows, 1)}
+    source = io.BytesIO(_template_cache.data(template_file))
+    
+    if previous is not None:
+        if isinstance(previous, dict):
+            prev_fp = previous
+        else:
+            if isinstance(previous, (str, os.PathLike)):
+                with open(previous, "rb") as f:
+                    data = f.read()
+            else:
+                data = previous.read()
+            prev_fp = fingerprint or extract_fingerprint(_previous_rows(io.BytesIO(data)))
+            source = io.BytesIO(data)
+        summary, changed_rows = diff_extract(prev_fp, sheet_rows)
+        if changes is not None:
+            changes.update(summary)
+        if not isinstance(previous, dict):
+            # Row 1 always: it carries the date (N1)
+            rows = {row_idx: rows[row_idx] for row_idx in changed_rows | {1}}
+    
+    patch_sheet_rows(source, output, EXTRACT_SHEET_NAME, rows, last_row=len(sheet_rows))
+    return sheet_rows
+
+# Last generated workbook and its fingerprint, for the next run's diff
+PREVIOUS_OUTPUT = os.getenv("EXCEL_PREVIOUS_OUTPUT", "previous_output.xlsm")
+PREVIOUS_FINGERPRINT = os.getenv("EXCEL_PREVIOUS_FINGERPRINT", "previous_output.json")
+
+def load_previous_output(template_file, path=PREVIOUS_OUTPUT, fingerprint_path=PREVIOUS_FINGERPRINT):
+    """
+    (previous, fingerprint) for the writers: previous is the stored workbook
+    (in memory) when it was generated from the current template and is the
+    one the fingerprint describes, else the fingerprint alone (change
+    summary only), else None.
+    """
+    if not os.path.exists(fingerprint_path):
+        return None, None
+    try:
+        with open(fingerprint_path, encoding="utf-8") as f:
+            fp = json.load(f)
+    except (OSError, ValueError):
+        return None, None
+    if fp.get("format") != FINGERPRINT_FORMAT:
+        return None, None
+    if fp.get("template") != _template_cache.sha(template_file):
+        return fp, fp
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return fp, fp
+    # Another run may have replaced one file but not yet the other
+    if fp.get("workbook") != hashlib.sha256(data).hexdigest():
+        return fp, fp
+    return io.BytesIO(data), fp
+
+def save_previous_output(template_file, data, sheet_rows, path=PREVIOUS_OUTPUT, fingerprint_path=PREVIOUS_FINGERPRINT):
+    """
+    Store a generated workbook (bytes) and the fingerprint of its extract
+    sheet rows. Each file is replaced atomically and the fingerprint carries
+    the workbook's sha256, so a reader never pairs it with another run's file.
+    """
+    fp = extract_fingerprint(sheet_rows, _template_cache.sha(template_file), hashlib.sha256(data).hexdigest())
+    replace_file(path, data)
+    replace_file(fingerprint_path, json.dumps(fp, ensure_ascii=False).encode("utf-8"))
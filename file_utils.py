@@ -0,0 +1,19 @@
+import os
+import tempfile
+
+def replace_file(path, data):
+    """
+    Write data (bytes) to path atomically: a uniquely named temp file in the
+    same directory, then os.replace. Concurrent writers never share a temp
+    file; the last replace wins.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
@@ -0,0 +1,101 @@
+import numpy as np
+from itertools import chain
+
+# Defaults for merge_data's offline fuzzy pass
+NGRAM_SIZE = 2
+MIN_SCORE = 0.3 # candidates below this are not considered at all
+# A match is accepted without review only if the query and the candidate
+# each share at least this fraction of their grams with the other, and no
+# other candidate covers the query that well (branch siblings such as
+# 「〇〇東」/「〇〇中央園」 of 「〇〇」 are never auto-accepted).
+ACCEPT_COVERAGE = 0.9
+TOP_K = 5
+
+def char_ngrams(text, n=NGRAM_SIZE):
+    """Set of character n-grams; short strings are their own single gram."""
+    if len(text) < n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+class NgramMatcher:
+    """
+    Character n-gram inverted index over candidate names.
+
+    Scoring a query is one pass over the postings of its n-grams:
+    np.bincount gives the intersection size with every candidate at once,
+    from which Jaccard or cosine similarity is computed for all candidates
+    as a vector. No network, no per-candidate Python loop.
+    """
+
+    def __init__(self, candidates, normalize=None, n=NGRAM_SIZE):
+        self.candidates = list(candidates)
+        self.normalize = normalize or (lambda s: s)
+        self.n = n
+
+        grams_per = [char_ngrams(self.normalize(c), n) for c in self.candidates]
+        flat = list(chain.from_iterable(grams_per))
+        gram_ids = {g: i for i, g in enumerate(dict.fromkeys(flat))}
+
+        self.gram_ids = gram_ids
+        grams = np.fromiter(map(gram_ids.__getitem__, flat), dtype=np.int64, count=len(flat))
+        cands = np.repeat(
+            np.arange(len(self.candidates), dtype=np.int64),
+            np.fromiter(map(len, grams_per), dtype=np.int64, count=len(grams_per))
+        )
+        # CSR layout: postings of gram g are post_cands[post_ptr[g]:post_ptr[g + 1]]
+        order = np.argsort(grams, kind="stable")
+        self.post_cands = cands[order]
+        self.post_ptr = np.searchsorted(grams[order], np.arange(len(gram_ids) + 1))
+        # Number of distinct grams per candidate
+        self.sizes = np.bincount(cands, minlength=len(self.candidates)).astype(np.float64)
+
+    def _intersections(self, name):
+        """(number of query grams, shared grams with every candidate as a numpy array)."""
+        query = char_ngrams(self.normalize(name), self.n)
+        inter = np.zeros(len(self.candidates))
+        ids = [self.gram_ids[g] for g in query if g in self.gram_ids]
+        if ids:
+            hits = np.concatenate([self.post_cands[self.post_ptr[g]:self.post_ptr[g + 1]] for g in ids])
+            inter = np.bincount(hits, minlength=len(self.candidates)).astype(np.float64)
+        return float(len(query)), inter
+
+    def scores(self, name, metric="jaccard"):
+        """Similarity of name to every candidate (numpy array, 0..1)."""
+        q, inter = self._intersections(name)
+        scores = np.zeros(len(self.candidates))
+        if not q or not inter.any():
+            return scores
+        if metric == "cosine":
+            denom = np.sqrt(q * self.sizes)
+        else:
+            denom = q + self.sizes - inter
+        np.divide(inter, denom, out=scores, where=denom > 0)
+        return scores
+
+    def match(self, name, threshold=MIN_SCORE, top_k=TOP_K, metric="jaccard"):
+        """Best candidates as [(candidate, score), ...], highest first."""
+        scores = self.scores(name, metric)
+        idx = np.flatnonzero(scores >= threshold)
+        if len(idx) == 0:
+            return []
+        if len(idx) > top_k:
+            idx = idx[np.argpartition(-scores[idx], top_k - 1)[:top_k]]
+        idx = idx[np.argsort(-scores[idx], kind="stable")]
+        return [(self.candidates[i], float(scores[i])) for i in idx]
+
+    def confident_match(self, name, coverage=ACCEPT_COVERAGE):
+        """
+        The one candidate that covers name and is covered by it (both at
+        least `coverage` of their grams), or None. Several candidates covering
+        name means siblings: nothing is returned, the caller has to decide.
+        """
+        q, inter = self._intersections(name)
+        if not q:
+            return None
+        covering = np.flatnonzero(inter / q >= coverage)
+        if len(covering) != 1:
+            return None
+        i = covering[0]
+        if self.sizes[i] == 0 or inter[i] / self.sizes[i] < coverage:
+            return None
+        return self.candidates[i]
@@ -1,69 +1,389 @@
 import requests
 import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+from retry_policy import MAX_RETRIES, RETRY_STATUS, backoff
 
 # Kintone Constants
-SUBDOMAIN = "n2amf" # From user URL: https://n2amf.cybozu.com/...
+SUBDOMAIN = os.getenv("KINTONE_SUBDOMAIN", "n2amf") # From user URL: https://n2amf.cybozu.com/...
+# Override to point the client at another host, e.g. the local stand-in
+# (kintone_stub_server.py): KINTONE_BASE_URL=http://127.0.0.1:8080
+BASE_URL = os.getenv("KINTONE_BASE_URL", "")
 NURSERY_APP_ID = 218
 BED_APP_ID = 32
 
-def fetch_all_records(app_id, api_token, base_query=""):
+# Parallel export settings
+# Kintone allows up to 100 concurrent requests per domain, stay well below that.
+FETCH_WORKERS = 4
+PAGE_LIMIT = 500
+
+# Field projection
+# Only the fields read by data_processor.merge_data and excel_manager
+# (update_excel / update_sheet) are requested. Add a code here before using
+# a new field downstream, otherwise it will be missing from the records.
+NURSERY_FIELDS = [
+    "$id", "status", "name", "client_name", "capacity", "open_date",
+    "addr_area", "addr_city", "基本開園日",
+    "sick_child_care", "sc_flg", "night_care", "ekbn2", "ekbn4",
+]
+BED_FIELDS = [
+    "$id", "保育園", "病床数合計_0",
+]
+
+# HTTP settings
+# One keep-alive session is shared by every fetch (both apps, all workers).
+REQUEST_TIMEOUT = 60 # seconds
+
+_session = None
+_session_lock = threading.Lock()
+
+# Query pushdown for the bed app: nursery names per `保育園 in (...)` query
+# (30 typical names are about 4 KB once percent-encoded, 9 bytes per kanji/kana)
+PUSHDOWN_CHUNK = 30
+# Requests whose encoded query string is longer are sent as
+# POST + X-HTTP-Method-Override: GET (8 KB URL limit of common servers/proxies)
+LONG_QUERY = 4000
+
+# app_id -> set of field codes, read once per process
+_form_fields_cache = {}
+
+def get_session():
+    """Process-wide pooled session (keep-alive, gzip)."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            # Both apps are fetched at the same time, each with FETCH_WORKERS threads
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=FETCH_WORKERS * 2)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({"Accept-Encoding": "gzip, deflate"})
+            _session = session
+    return _session
+
+def _request(method, url, **kwargs):
     """
-    Fetch all records using ID-based pagination to bypass 10k offset limit.
+    Send a request over the shared session.
+    429/5xx responses and connection errors are retried with jittered
+    exponential backoff; the last response (or error) is returned/raised.
     """
-    url = f"https://{SUBDOMAIN}.cybozu.com/k/v1/records.json"
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            resp = get_session().request(method, url, timeout=REQUEST_TIMEOUT, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == MAX_RETRIES:
+                raise
+            time.sleep(backoff(attempt))
+            continue
+
+        if resp.status_code in RETRY_STATUS and attempt < MAX_RETRIES:
+            time.sleep(backoff(attempt, resp.headers.get("Retry-After")))
+            continue
+        return resp
+
+def _api_url(path):
+    base = BASE_URL or f"https://{SUBDOMAIN}.cybozu.com"
+    return f"{base.rstrip('/')}/k/v1/{path}"
+
+def _records_url():
+    return _api_url("records.json")
+
+def _get_records(app_id, api_token, query, total_count=False, fields=None):
+    """Single GET against /k/v1/records.json. Returns the decoded JSON."""
     headers = {"X-Cybozu-API-Token": api_token}
-    records = []
-    limit = 500
-    last_id = 0
-    
+    params = {"app": app_id, "query": query}
+    if total_count:
+        params["totalCount"] = "true"
+    if fields:
+        # Kintone expects fields[0]=...&fields[1]=... on GET
+        for i, code in enumerate(fields):
+            params[f"fields[{i}]"] = code
+    # The URL limit applies to the percent-encoded form, not to len(query)
+    if len(urllib.parse.urlencode(params)) > LONG_QUERY:
+        # Same GET semantics, parameters in a JSON body
+        headers["X-HTTP-Method-Override"] = "GET"
+        body = {"app": app_id, "query": query, "totalCount": total_count}
+        if fields:
+            body["fields"] = list(fields)
+        resp = _request("POST", _records_url(), headers=headers, json=body)
+    else:
+        resp = _request("GET", _records_url(), headers=headers, params=params)
+
+    if resp.status_code != 200:
+        raise Exception(f"Kintone API Error ({app_id}): {resp.text}")
+    return resp.json()
+
+def get_form_fields(app_id, api_token):
+    """
+    Return the set of field codes defined in the app's form.
+    The schema is read once per process and cached.
+    """
+    if app_id not in _form_fields_cache:
+        headers = {"X-Cybozu-API-Token": api_token}
+        resp = _request("GET", _api_url("app/form/fields.json"), headers=headers, params={"app": app_id})
+        if resp.status_code != 200:
+            raise Exception(f"Kintone Form API Error ({app_id}): {resp.text}")
+        _form_fields_cache[app_id] = set(resp.json().get("properties", {}).keys())
+    return _form_fields_cache[app_id]
+
+def resolve_fields(app_id, api_token, fields):
+    """
+    Validate the requested field codes against the app's form schema.
+    Raises if any code does not exist, instead of silently returning records
+    without it.
+    """
+    known = get_form_fields(app_id, api_token)
+    # "$id" / "$revision" are always available and not part of the form
+    missing = [f for f in fields if not f.startswith("$") and f not in known]
+    if missing:
+        raise Exception(
+            f"Kintone field code(s) not found in app {app_id}: {', '.join(missing)}"
+        )
+    # $id is required for pagination
+    if "$id" not in fields:
+        fields = ["$id"] + list(fields)
+    return list(fields)
+
+class KintoneRow:
+    """
+    Compact Kintone record holding only field values.
+
+    The raw API shape {"name": {"type": ..., "value": ...}} is decoded once per
+    page; rows of the same page share one field -> position index, so each row
+    is just a tuple of values.
+    row.get("name") replaces rec.get("name", {}).get("value", "").
+    """
+    __slots__ = ("_index", "_values")
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = values
+
+    def get(self, field, default=""):
+        i = self._index.get(field)
+        if i is None:
+            return default
+        value = self._values[i]
+        return default if value is None else value
+
+    def __getitem__(self, field):
+        return self._values[self._index[field]]
+
+    def __contains__(self, field):
+        return field in self._index
+
+    def keys(self):
+        return self._index.keys()
+
+    def to_dict(self):
+        return {f: self._values[i] for f, i in self._index.items()}
+
+    def __repr__(self):
+        return f"KintoneRow({self.to_dict()!r})"
+
+def _decode_page(raw_records, index=None):
+    """Turn one page of raw API records into KintoneRow objects."""
+    if index is None:
+        # No projection: derive the layouts from the records themselves
+        return list(rows_from_dicts(
+            {f: v.get("value") for f, v in raw.items()} for raw in raw_records
+        ))
+    return [
+        KintoneRow(index, tuple(raw[f]["value"] if f in raw else None for f in index))
+        for raw in raw_records
+    ]
+
+def rows_from_dicts(items):
+    """Build KintoneRow objects from plain {field: value} dicts, sharing layouts."""
+    layouts = {}
+    for d in items:
+        keys = tuple(d)
+        index = layouts.get(keys)
+        if index is None:
+            index = layouts[keys] = {f: i for i, f in enumerate(keys)}
+        yield KintoneRow(index, tuple(d.values()))
+
+def quote_value(value):
+    """Kintone query string literal."""
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def _with_condition(base_query, condition):
+    """Combine the caller's filter with an extra $id condition."""
+    if base_query:
+        return f"({base_query}) and {condition}"
+    return condition
+
+def _iter_id_range(app_id, api_token, base_query, low_id, high_id, fields=None, limit=PAGE_LIMIT):
+    """
+    Yield KintoneRow objects with low_id < $id <= high_id (high_id=None means
+    no upper bound), one page at a time.
+    Uses ID-based pagination to bypass 10k offset limit.
+    """
+    last_id = low_id
+    # With a projection every record has the same fields: share one layout
+    index = {f: i for i, f in enumerate(fields)} if fields else None
+
     while True:
         # Construct query: (Original Condition) and $id > last_id order by $id asc
-        if base_query:
-            query = f"({base_query}) and $id > {last_id} order by $id asc limit {limit}"
-        else:
-            query = f"$id > {last_id} order by $id asc limit {limit}"
-            
-        params = {
-            "app": app_id,
-            "query": query,
-            "fields": [
-                "$id", "status", "name", "client_name", "capacity", "open_date", 
-                "addr_area", "addr_city", "保育園", "病床数合計_0",
-                "sick_child_care", "sc_flg", "night_care", "ekbn2", "ekbn4",
-                "基本開園日"
-            ] 
-            # Ideally fetch all fields, but Kintone might error if too many.
-            # To be safe, let's NOT specify fields and get all, unless payload is too huge.
-            # The error 'offset' implies payload size wasn't the issue, just count.
-            # Let's try fetching ALL fields first.
-        }
-        
-        # If we don't specify fields, we get all.
-        del params["fields"]
-
-        resp = requests.get(url, headers=headers, params=params)
-        if resp.status_code != 200:
-            raise Exception(f"Kintone API Error ({app_id}): {resp.text}")
-            
-        data = resp.json()
+        condition = f"$id > {last_id}"
+        if high_id is not None:
+            condition += f" and $id <= {high_id}"
+        query = f"{_with_condition(base_query, condition)} order by $id asc limit {limit}"
+
+        data = _get_records(app_id, api_token, query, fields=fields)
         rec_batch = data.get("records", [])
-        
+        del data
+
         if not rec_batch:
             break
-            
-        records.extend(rec_batch)
+
         last_id = rec_batch[-1]["$id"]["value"]
-        
+        yield from _decode_page(rec_batch, index)
+
         if len(rec_batch) < limit:
             break
-        
+
+def _fetch_id_range(app_id, api_token, base_query, low_id, high_id, fields=None):
+    return list(_iter_id_range(app_id, api_token, base_query, low_id, high_id, fields))
+
+def _id_bounds(app_id, api_token, base_query):
+    """
+    Return (min_id, max_id, total_count) of the records matching base_query,
+    or None if nothing matches.
+    """
+    head = _get_records(
+        app_id, api_token,
+        f"{base_query} order by $id asc limit 1".strip(),
+        total_count=True, fields=["$id"]
+    )
+    if not head.get("records"):
+        return None
+    tail = _get_records(app_id, api_token, f"{base_query} order by $id desc limit 1".strip(), fields=["$id"])
+
+    min_id = int(head["records"][0]["$id"]["value"])
+    max_id = int(tail["records"][0]["$id"]["value"])
+    total = int(head.get("totalCount") or 0)
+    return min_id, max_id, total
+
+def iter_records(app_id, api_token, base_query="", fields=None):
+    """
+    Generator version of fetch_all_records (serial).
+    Only one page of raw JSON is resident at a time.
+    """
+    if fields is not None:
+        fields = resolve_fields(app_id, api_token, fields)
+    return _iter_id_range(app_id, api_token, base_query, 0, None, fields)
+
+def fetch_all_records(app_id, api_token, base_query="", workers=1, fields=None):
+    """
+    Fetch all records using ID-based pagination to bypass 10k offset limit.
+    Returns a list of KintoneRow.
+
+    fields: list of field codes to return (checked against the form schema).
+            None returns every field, including subtables.
+
+    With workers > 1 the $id space is pre-split into contiguous ranges that are
+    fetched concurrently. Ranges are concatenated in $id order, so the result
+    is identical to the serial fetch.
+    """
+    if fields is not None:
+        fields = resolve_fields(app_id, api_token, fields)
+
+    if workers <= 1:
+        return _fetch_id_range(app_id, api_token, base_query, 0, None, fields)
+
+    bounds = _id_bounds(app_id, api_token, base_query)
+    if bounds is None:
+        return []
+    min_id, max_id, total = bounds
+
+    # Small result sets are faster in one serial pass than two extra probes + pool.
+    if total <= PAGE_LIMIT:
+        return _fetch_id_range(app_id, api_token, base_query, min_id - 1, None, fields)
+
+    # Split $id space evenly. Size ranges so that each one is expected to fit
+    # in a single page (with headroom for uneven id density); a range that
+    # fills a page costs an extra round trip.
+    n_ranges = max(workers, -(-total // int(PAGE_LIMIT * 0.8)))
+    span = max_id - (min_id - 1)
+    step = -(-span // n_ranges) # ceil division
+    edges = list(range(min_id - 1, max_id, step)) + [max_id]
+
+    ranges = list(zip(edges[:-1], edges[1:]))
+    # Last range is open-ended so records added after the probe are not missed.
+    ranges[-1] = (ranges[-1][0], None)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        chunks = pool.map(
+            lambda r: _fetch_id_range(app_id, api_token, base_query, r[0], r[1], fields),
+            ranges
+        )
+        records = []
+        for chunk in chunks:
+            records.extend(chunk)
+
     return records
 
-def get_nursery_data(api_token):
+def get_nursery_data(api_token, workers=FETCH_WORKERS, store=None):
     # Filter: Status (開園状態 -> status) in "開園", "開園予定"
     query = 'status in ("開園", "開園予定")'
-    return fetch_all_records(NURSERY_APP_ID, api_token, query)
+    # store: kintone_snapshot.SnapshotStore for incremental sync
+    if store is not None:
+        return store.sync(NURSERY_APP_ID, api_token, query, fields=NURSERY_FIELDS, workers=workers)
+    return fetch_all_records(NURSERY_APP_ID, api_token, query, workers=workers, fields=NURSERY_FIELDS)
 
-def get_bed_data(api_token):
+def get_bed_data_for(api_token, nursery_names, workers=FETCH_WORKERS):
+    """
+    Fetch only the bed records whose 保育園 is one of nursery_names.
+    The names are pushed into Kintone as chunked `保育園 in (...)` queries,
+    issued concurrently; records are deduplicated and returned in $id order.
+    """
+    names = sorted({n for n in nursery_names if n})
+    if not names:
+        return []
+    chunks = [names[i:i + PUSHDOWN_CHUNK] for i in range(0, len(names), PUSHDOWN_CHUNK)]
+    queries = [f"保育園 in ({', '.join(quote_value(n) for n in chunk)})" for chunk in chunks]
+
+    by_id = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(
+            lambda q: fetch_all_records(BED_APP_ID, api_token, q, fields=BED_FIELDS),
+            queries
+        )
+        for rows in results:
+            for r in rows:
+                by_id[int(r["$id"])] = r
+    return [by_id[i] for i in sorted(by_id)]
+
+def get_bed_data(api_token, workers=FETCH_WORKERS, store=None, nursery_names=None):
+    # nursery_names: push the join key down to Kintone instead of fetching all.
+    # Only exact name matches are returned, so the name normalization /
+    # fuzzy matching in merge_data has no other candidates to work with.
+    if nursery_names is not None:
+        return get_bed_data_for(api_token, nursery_names, workers)
     # Fetch all for matching
-    return fetch_all_records(BED_APP_ID, api_token)
+    if store is not None:
+        return store.sync(BED_APP_ID, api_token, fields=BED_FIELDS, workers=workers)
+    return fetch_all_records(BED_APP_ID, api_token, workers=workers, fields=BED_FIELDS)
+
+def get_all_data(nursery_token, bed_token, workers=FETCH_WORKERS, store=None, bed_pushdown=False):
+    """
+    Fetch the nursery app and the bed app at the same time.
+    Returns (nursery_records, bed_records).
+
+    bed_pushdown: fetch only bed records matching an open nursery name.
+    The bed fetch then has to wait for the nursery fetch.
+    """
+    if bed_pushdown:
+        nursery_records = get_nursery_data(nursery_token, workers, store)
+        names = [r.get("name", "") for r in nursery_records]
+        return nursery_records, get_bed_data(bed_token, workers, nursery_names=names)
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        nursery_future = pool.submit(get_nursery_data, nursery_token, workers, store)
+        bed_future = pool.submit(get_bed_data, bed_token, workers, store)
+        return nursery_future.result(), bed_future.result()
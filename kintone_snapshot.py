@@ -0,0 +1,155 @@
+import sqlite3
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+from kintone_client import fetch_all_records, get_form_fields, rows_from_dicts, FETCH_WORKERS
+
+# Local copy of the Kintone apps, so that later runs only download the
+# records changed since the previous sync.
+SNAPSHOT_DB = os.getenv("KINTONE_SNAPSHOT_DB", "kintone_snapshot.db")
+
+# System field "更新日時" (UPDATED_TIME). Checked against the app's form
+# before each incremental sync; without it every sync is a full fetch.
+UPDATED_TIME_FIELD = os.getenv("KINTONE_UPDATED_TIME_FIELD", "更新日時")
+
+# Re-fetch a little before the last sync time to cover clock skew between
+# this server and Kintone. Records fetched twice are simply upserted again.
+SYNC_OVERLAP = timedelta(minutes=5)
+
+# Bump when the stored record layout changes; forces a full re-fetch.
+SNAPSHOT_FORMAT = 2
+
+class SnapshotStore:
+    """
+    SQLite store of Kintone records keyed by (app, scope, $id).
+    scope is the base query, so a filtered fetch (e.g. open nurseries only)
+    has its own snapshot independent of a full fetch of the same app.
+    """
+
+    def __init__(self, path=SNAPSHOT_DB):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS records (
+                    app_id INTEGER NOT NULL,
+                    scope TEXT NOT NULL,
+                    record_id INTEGER NOT NULL,
+                    revision INTEGER,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (app_id, scope, record_id)
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    app_id INTEGER NOT NULL,
+                    scope TEXT NOT NULL,
+                    fields TEXT NOT NULL,
+                    last_sync TEXT NOT NULL,
+                    PRIMARY KEY (app_id, scope)
+                )
+            """)
+
+    def close(self):
+        self.conn.close()
+
+    def _get_state(self, app_id, scope):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT fields, last_sync FROM sync_state WHERE app_id = ? AND scope = ?",
+                (app_id, scope)
+            ).fetchone()
+        return row
+
+    def _upsert(self, app_id, scope, records):
+        rows = []
+        for r in records:
+            rev = r.get("$revision")
+            rows.append((
+                app_id, scope, int(r["$id"]),
+                int(rev) if rev else None,
+                json.dumps(r.to_dict(), ensure_ascii=False)
+            ))
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO records (app_id, scope, record_id, revision, data) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+
+    def _replace_all(self, app_id, scope, records, fields_sig, sync_time):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM records WHERE app_id = ? AND scope = ?", (app_id, scope))
+        self._upsert(app_id, scope, records)
+        self._save_state(app_id, scope, fields_sig, sync_time)
+
+    def _delete_missing(self, app_id, scope, live_ids):
+        """Remove records that were deleted in Kintone or no longer match scope."""
+        with self.lock:
+            stored = [r[0] for r in self.conn.execute(
+                "SELECT record_id FROM records WHERE app_id = ? AND scope = ?", (app_id, scope)
+            )]
+        gone = [(app_id, scope, rid) for rid in stored if rid not in live_ids]
+        if gone:
+            with self.lock, self.conn:
+                self.conn.executemany(
+                    "DELETE FROM records WHERE app_id = ? AND scope = ? AND record_id = ?", gone
+                )
+        return len(gone)
+
+    def _save_state(self, app_id, scope, fields_sig, sync_time):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sync_state (app_id, scope, fields, last_sync) VALUES (?, ?, ?, ?)",
+                (app_id, scope, fields_sig, sync_time)
+            )
+
+    def load(self, app_id, scope=""):
+        """Return the stored records of (app, scope) in $id order, as KintoneRow."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT data FROM records WHERE app_id = ? AND scope = ? ORDER BY record_id",
+                (app_id, scope)
+            ).fetchall()
+        return list(rows_from_dicts(json.loads(r[0]) for r in rows))
+
+    def sync(self, app_id, api_token, base_query="", fields=None, workers=FETCH_WORKERS):
+        """
+        Bring the snapshot of (app, base_query) up to date and return its records.
+
+        First run (or a changed field list) does a full fetch. Later runs fetch
+        records updated since the last sync plus the live $id list, which is
+        used to drop deleted records. Apps whose form has no
+        UPDATED_TIME_FIELD are always fetched in full.
+        """
+        if fields is not None and "$revision" not in fields:
+            fields = list(fields) + ["$revision"]
+        fields_sig = json.dumps({"format": SNAPSHOT_FORMAT, "fields": fields}, ensure_ascii=False)
+
+        # Kintone datetime literal, UTC
+        now = datetime.now(timezone.utc)
+        sync_time = (now - SYNC_OVERLAP).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        state = self._get_state(app_id, base_query)
+        if (state is None or state[0] != fields_sig
+                or UPDATED_TIME_FIELD not in get_form_fields(app_id, api_token)):
+            records = fetch_all_records(app_id, api_token, base_query, workers=workers, fields=fields)
+            self._replace_all(app_id, base_query, records, fields_sig, sync_time)
+            return records
+
+        last_sync = state[1]
+        changed_query = f'{UPDATED_TIME_FIELD} > "{last_sync}"'
+        if base_query:
+            changed_query = f"({base_query}) and {changed_query}"
+
+        changed = fetch_all_records(app_id, api_token, changed_query, workers=workers, fields=fields)
+        live = fetch_all_records(app_id, api_token, base_query, workers=workers, fields=["$id"])
+        live_ids = {int(r["$id"]) for r in live}
+
+        self._upsert(app_id, base_query, changed)
+        self._delete_missing(app_id, base_query, live_ids)
+        self._save_state(app_id, base_query, fields_sig, sync_time)
+
+        return self.load(app_id, base_query)
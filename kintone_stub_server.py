@@ -0,0 +1,505 @@
+"""
+Local stand-in for the Kintone REST API, for measuring kintone_client offline.
+
+Serves:
+    GET    /k/v1/records.json           (query / fields / totalCount, 10k offset limit;
+                                         also POST with X-HTTP-Method-Override: GET)
+    POST   /k/v1/records/cursor.json    (create cursor)
+    GET    /k/v1/records/cursor.json    (read next page)
+    DELETE /k/v1/records/cursor.json    (delete cursor)
+    GET    /k/v1/app/form/fields.json
+
+Usage:
+    python kintone_stub_server.py --records 50000 --latency 0.05 --error-rate 0.02
+    KINTONE_BASE_URL=http://127.0.0.1:8080 streamlit run app.py
+
+Fixtures are synthetic (--records / --bed-records) or recorded from the real
+tenant with --save-fixture, then replayed with --fixture.
+"""
+import argparse
+import bisect
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import kintone_client
+
+OFFSET_LIMIT = 10000
+MAX_LIMIT = 500
+
+PREFECTURES = ["北海道", "宮城県", "東京都", "神奈川県", "愛知県", "大阪府", "兵庫県", "福岡県", "沖縄県"]
+
+# --- Fixtures ---
+
+def _field(type_, value):
+    return {"type": type_, "value": value}
+
+def make_nursery_records(n, extra_fields=0, seed=0):
+    """Synthetic records shaped like app 218."""
+    rnd = random.Random(seed)
+    records = []
+    for i in range(1, n + 1):
+        rec = {
+            "$id": _field("__ID__", str(i)),
+            "$revision": _field("__REVISION__", str(rnd.randint(1, 20))),
+            "更新日時": _field("UPDATED_TIME", f"2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}T00:00:00Z"),
+            "status": _field("DROP_DOWN", rnd.choice(["開園", "開園", "開園", "開園予定", "閉園"])),
+            "name": _field("SINGLE_LINE_TEXT", f"テスト保育園{i}"),
+            "client_name": _field("SINGLE_LINE_TEXT", f"テスト病院{i % 500}"),
+            "capacity": _field("NUMBER", str(rnd.randint(5, 60))),
+            "open_date": _field("DATE", f"20{rnd.randint(10, 24)}-04-01"),
+            "addr_area": _field("DROP_DOWN", rnd.choice(PREFECTURES)),
+            "addr_city": _field("SINGLE_LINE_TEXT", f"市{rnd.randint(1, 50)}"),
+            "基本開園日": _field("CHECK_BOX", rnd.sample(["月", "火", "水", "木", "金", "土", "日"], 5)),
+            "sick_child_care": _field("CHECK_BOX", rnd.choice([[], ["有"]])),
+            "sc_flg": _field("CHECK_BOX", rnd.choice([[], ["有"]])),
+            "night_care": _field("CHECK_BOX", rnd.choice([[], ["有"]])),
+            "ekbn2": _field("CHECK_BOX", ["企業主導型"]),
+            "ekbn4": _field("CHECK_BOX", rnd.choice([["院内"], ["院外"]])),
+        }
+        # Padding fields to simulate a wide app
+        for j in range(extra_fields):
+            rec[f"extra_{j}"] = _field("MULTI_LINE_TEXT", "x" * 40)
+        records.append(rec)
+    return records
+
+def make_bed_records(n, nursery_count, seed=1):
+    """Synthetic records shaped like app 32, keyed by nursery name."""
+    rnd = random.Random(seed)
+    records = []
+    for i in range(1, n + 1):
+        records.append({
+            "$id": _field("__ID__", str(i)),
+            "$revision": _field("__REVISION__", "1"),
+            "更新日時": _field("UPDATED_TIME", "2024-01-01T00:00:00Z"),
+            "保育園": _field("SINGLE_LINE_TEXT", f"テスト保育園{rnd.randint(1, max(1, nursery_count * 2))}"),
+            "病床数合計_0": _field("NUMBER", str(rnd.randint(0, 12))),
+        })
+    return records
+
+def save_fixture(path, tokens):
+    """
+    Record the real apps into a fixture file.
+    tokens: {app_id: api_token}
+    """
+    apps = {}
+    for app_id, token in tokens.items():
+        rows = kintone_client.fetch_all_records(app_id, token, workers=kintone_client.FETCH_WORKERS)
+        # Field types are not kept by KintoneRow; they are only used by the form endpoint
+        apps[str(app_id)] = [{f: {"type": "", "value": v} for f, v in r.to_dict().items()} for r in rows]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(apps, f, ensure_ascii=False)
+
+def load_fixture(path):
+    with open(path, encoding="utf-8") as f:
+        return {int(app_id): records for app_id, records in json.load(f).items()}
+
+# --- Query language (subset used by kintone_client) ---
+
+_TOKEN_RE = re.compile(r'\s*(?:("(?:\\.|[^"\\])*")|(>=|<=|!=|=|>|<|\(|\)|,)|([^\s()=<>!,"]+))')
+
+def _tokenize(query):
+    tokens = []
+    pos = 0
+    query = query.strip()
+    while pos < len(query):
+        m = _TOKEN_RE.match(query, pos)
+        if not m or m.end() == pos:
+            raise ValueError(f"Cannot parse query near: {query[pos:]}")
+        string, op, word = m.groups()
+        if string is not None:
+            tokens.append(("str", re.sub(r'\\(.)', r'\1', string[1:-1])))
+        elif op is not None:
+            tokens.append(("op", op))
+        else:
+            tokens.append(("word", word))
+        pos = m.end()
+    return tokens
+
+class _Parser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.i = 0
+
+    def peek(self):
+        return self.tokens[self.i] if self.i < len(self.tokens) else (None, None)
+
+    def take(self):
+        tok = self.peek()
+        self.i += 1
+        return tok
+
+    def keyword(self, word):
+        kind, val = self.peek()
+        if kind == "word" and val.lower() == word:
+            self.i += 1
+            return True
+        return False
+
+    def parse(self):
+        cond = None
+        kind, val = self.peek()
+        if kind is not None and not (kind == "word" and val.lower() in ("order", "limit", "offset")):
+            cond = self.expr()
+        order, limit, offset = [], 100, 0
+        while self.peek()[0] is not None:
+            if self.keyword("order"):
+                self.keyword("by")
+                while True:
+                    field = self.take()[1]
+                    direction = "asc"
+                    if self.peek()[1] in ("asc", "desc"):
+                        direction = self.take()[1]
+                    order.append((field, direction))
+                    if self.peek() == ("op", ","):
+                        self.take()
+                        continue
+                    break
+            elif self.keyword("limit"):
+                limit = int(self.take()[1])
+            elif self.keyword("offset"):
+                offset = int(self.take()[1])
+            else:
+                raise ValueError(f"Unexpected token: {self.peek()[1]}")
+        return cond, order, limit, offset
+
+    def expr(self):
+        node = self.and_expr()
+        while self.keyword("or"):
+            node = ("or", node, self.and_expr())
+        return node
+
+    def and_expr(self):
+        node = self.term()
+        while self.keyword("and"):
+            node = ("and", node, self.term())
+        return node
+
+    def term(self):
+        if self.peek() == ("op", "("):
+            self.take()
+            node = self.expr()
+            self.take() # ")"
+            return node
+        field = self.take()[1]
+        negate = self.keyword("not")
+        if self.keyword("in"):
+            self.take() # "("
+            values = []
+            while self.peek() not in (("op", ")"), (None, None)):
+                kind, val = self.take()
+                if kind != "op":
+                    values.append(val)
+            self.take() # ")"
+            return ("not in" if negate else "in", field, values)
+        op = self.take()[1]
+        value = self.take()[1]
+        return (op, field, value)
+
+def _cell(record, field):
+    value = record.get(field, {}).get("value")
+    if field in ("$id", "$revision"):
+        return int(value)
+    return value
+
+def _matches(record, node):
+    if node is None:
+        return True
+    op = node[0]
+    if op == "and":
+        return _matches(record, node[1]) and _matches(record, node[2])
+    if op == "or":
+        return _matches(record, node[1]) or _matches(record, node[2])
+
+    field, value = node[1], node[2]
+    cell = _cell(record, field)
+    if op in ("in", "not in"):
+        # CHECK_BOX / DROP_DOWN: list values match if any element is in the set
+        items = cell if isinstance(cell, list) else [cell]
+        hit = any(str(v) in value for v in items)
+        return hit if op == "in" else not hit
+    if isinstance(cell, int):
+        value = int(value)
+    if cell is None:
+        return False
+    return {
+        "=": cell == value, "!=": cell != value,
+        ">": cell > value, ">=": cell >= value,
+        "<": cell < value, "<=": cell <= value,
+    }[op]
+
+def _select(records, cond, order):
+    hits = [r for r in records if _matches(r, cond)]
+    # Kintone default order is $id desc
+    for field, direction in reversed(order or [("$id", "desc")]):
+        hits.sort(key=lambda r: _cell(r, field), reverse=(direction == "desc"))
+    return hits
+
+def _id_bounds(node):
+    """($id lower, upper) bounds implied by top-level `and` conditions on $id."""
+    if node is None:
+        return 0, None
+    if node[0] == "and":
+        lo1, hi1 = _id_bounds(node[1])
+        lo2, hi2 = _id_bounds(node[2])
+        his = [h for h in (hi1, hi2) if h is not None]
+        return max(lo1, lo2), (min(his) if his else None)
+    if node[1] == "$id" and node[0] in (">", ">=", "<", "<="):
+        value = int(node[2])
+        if node[0] == ">":
+            return value + 1, None
+        if node[0] == ">=":
+            return value, None
+        return 0, (value - 1 if node[0] == "<" else value)
+    return 0, None
+
+def run_query(records, query, ids=None, total_count=True):
+    """
+    Filter/sort/page records. Raises ValueError on the 10k offset limit.
+
+    ids: sorted $id list of records (records in $id asc order). Enables the
+    fast path for the client's "$id > N order by $id asc limit L" pages, so
+    the stub itself stays cheap next to the injected latency.
+    """
+    cond, order, limit, offset = _Parser(_tokenize(query or "")).parse()
+    if limit > MAX_LIMIT:
+        raise ValueError(f"limit must be <= {MAX_LIMIT}")
+    if offset > OFFSET_LIMIT:
+        raise ValueError(f"offset must be <= {OFFSET_LIMIT}")
+
+    if ids is not None and not total_count and order == [("$id", "asc")]:
+        low, high = _id_bounds(cond)
+        start = bisect.bisect_left(ids, low)
+        end = len(ids) if high is None else bisect.bisect_right(ids, high)
+        page = []
+        for r in records[start:end]:
+            if _matches(r, cond):
+                page.append(r)
+                if len(page) == offset + limit:
+                    break
+        return page[offset:], None
+
+    hits = _select(records, cond, order)
+    return hits[offset:offset + limit], len(hits)
+
+def _project(record, fields):
+    if not fields:
+        return record
+    return {f: record[f] for f in fields if f in record}
+
+# --- HTTP server ---
+
+class KintoneStub:
+    """Fixture data plus fault-injection settings shared by all handler threads."""
+
+    def __init__(self, apps, latency=0.0, error_rate=0.0, max_concurrent=0, seed=0):
+        # {app_id: [raw records]}, kept in $id order for the fast path
+        self.apps = {
+            app_id: sorted(records, key=lambda r: int(r["$id"]["value"]))
+            for app_id, records in apps.items()
+        }
+        self.ids = {app_id: [int(r["$id"]["value"]) for r in records] for app_id, records in self.apps.items()}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_concurrent = max_concurrent
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.cursors = {}
+        self.request_count = 0
+
+    def form_fields(self, app_id):
+        props = {}
+        for rec in self.apps.get(app_id, [])[:1]:
+            for code, cell in rec.items():
+                if not code.startswith("$"):
+                    props[code] = {"type": cell.get("type", ""), "code": code, "label": code}
+        return props
+
+class _Handler(BaseHTTPRequestHandler):
+    stub = None # set by make_server
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body):
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _error(self, status, code, message):
+        self._send(status, {"code": code, "id": uuid.uuid4().hex, "message": message})
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _dispatch(self, method):
+        stub = self.stub
+        with stub.lock:
+            stub.request_count += 1
+            stub.active += 1
+            over_limit = stub.max_concurrent and stub.active > stub.max_concurrent
+            throttled = stub.rnd.random() < stub.error_rate
+        try:
+            if stub.latency:
+                time.sleep(stub.latency)
+            if not self.headers.get("X-Cybozu-API-Token"):
+                return self._error(401, "CB_AU01", "Authentication required.")
+            if over_limit or throttled:
+                return self._error(429, "GAIA_TM12", "Too many concurrent requests.")
+
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            route = (method, url.path)
+            if route == ("GET", "/k/v1/records.json"):
+                return self._records(params)
+            if route == ("POST", "/k/v1/records.json") and self.headers.get("X-HTTP-Method-Override") == "GET":
+                # Long queries: GET parameters sent as a JSON body
+                body = self._body()
+                params = {"app": body.get("app"), "query": body.get("query", "")}
+                if body.get("totalCount"):
+                    params["totalCount"] = "true"
+                for i, code in enumerate(body.get("fields") or []):
+                    params[f"fields[{i}]"] = code
+                return self._records(params)
+            if route == ("GET", "/k/v1/app/form/fields.json"):
+                return self._send(200, {"properties": stub.form_fields(int(params.get("app", 0))), "revision": "1"})
+            if url.path == "/k/v1/records/cursor.json":
+                return self._cursor(method, params)
+            return self._error(404, "CB_NO02", f"No such API: {method} {url.path}")
+        finally:
+            with stub.lock:
+                stub.active -= 1
+
+    def _records(self, params):
+        app_id = int(params.get("app", 0))
+        if app_id not in self.stub.apps:
+            return self._error(404, "GAIA_AP01", "The app does not exist.")
+        fields = [params[k] for k in sorted(
+            (k for k in params if k.startswith("fields[")), key=lambda k: int(k[7:-1])
+        )]
+        try:
+            page, total = run_query(
+                self.stub.apps[app_id], params.get("query", ""),
+                ids=self.stub.ids[app_id], total_count=params.get("totalCount") == "true"
+            )
+        except ValueError as e:
+            return self._error(400, "GAIA_QU01", str(e))
+        body = {"records": [_project(r, fields) for r in page], "totalCount": None}
+        if params.get("totalCount") == "true":
+            body["totalCount"] = str(total)
+        self._send(200, body)
+
+    def _cursor(self, method, params):
+        stub = self.stub
+        if method == "POST":
+            body = self._body()
+            app_id = int(body.get("app", 0))
+            if app_id not in stub.apps:
+                return self._error(404, "GAIA_AP01", "The app does not exist.")
+            try:
+                # Cursor returns every match; limit/offset are not allowed
+                cond, order, _, _ = _Parser(_tokenize(body.get("query", ""))).parse()
+                hits = _select(stub.apps[app_id], cond, order)
+            except ValueError as e:
+                return self._error(400, "GAIA_QU01", str(e))
+            cursor_id = uuid.uuid4().hex
+            with stub.lock:
+                stub.cursors[cursor_id] = {
+                    "records": hits, "pos": 0,
+                    "size": int(body.get("size", 100)), "fields": body.get("fields") or [],
+                }
+            return self._send(200, {"id": cursor_id, "totalCount": str(len(hits))})
+
+        if method == "GET":
+            cursor = stub.cursors.get(params.get("id"))
+            if cursor is None:
+                return self._error(400, "GAIA_CO01", "The specified cursor does not exist.")
+            with stub.lock:
+                start = cursor["pos"]
+                cursor["pos"] += cursor["size"]
+            page = cursor["records"][start:start + cursor["size"]]
+            has_next = cursor["pos"] < len(cursor["records"])
+            if not has_next:
+                stub.cursors.pop(params.get("id"), None)
+            return self._send(200, {"records": [_project(r, cursor["fields"]) for r in page], "next": has_next})
+
+        if method == "DELETE":
+            stub.cursors.pop(self._body().get("id"), None)
+            return self._send(200, {})
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+def make_server(stub, host="127.0.0.1", port=8080):
+    """Create (not start) a threaded HTTP server for the stub. port=0 picks a free port."""
+    handler = type("KintoneStubHandler", (_Handler,), {"stub": stub})
+    return ThreadingHTTPServer((host, port), handler)
+
+def start_server(stub, host="127.0.0.1", port=0):
+    """
+    Start the stub in a background thread and point kintone_client at it.
+    Returns the server; call server.shutdown() when done.
+    """
+    server = make_server(stub, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    kintone_client.BASE_URL = f"http://{host}:{server.server_port}"
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Kintone stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--records", type=int, default=1000, help="synthetic nursery records (app 218)")
+    parser.add_argument("--bed-records", type=int, default=None, help="synthetic bed records (app 32), default = --records")
+    parser.add_argument("--extra-fields", type=int, default=0, help="padding fields per nursery record")
+    parser.add_argument("--fixture", help="replay a fixture file instead of synthetic data")
+    parser.add_argument("--save-fixture", help="record the real apps to this file and exit")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of a 429 response")
+    parser.add_argument("--max-concurrent", type=int, default=0, help="429 above this many in-flight requests")
+    args = parser.parse_args()
+
+    if args.save_fixture:
+        import os
+        from dotenv import load_dotenv
+        load_dotenv()
+        save_fixture(args.save_fixture, {
+            kintone_client.NURSERY_APP_ID: os.getenv("KINTONE_API_TOKEN_NURSERY", ""),
+            kintone_client.BED_APP_ID: os.getenv("KINTONE_API_TOKEN_CLIENT", ""),
+        })
+        print(f"Fixture saved: {args.save_fixture}")
+        return
+
+    if args.fixture:
+        apps = load_fixture(args.fixture)
+    else:
+        bed_count = args.records if args.bed_records is None else args.bed_records
+        apps = {
+            kintone_client.NURSERY_APP_ID: make_nursery_records(args.records, args.extra_fields),
+            kintone_client.BED_APP_ID: make_bed_records(bed_count, args.records),
+        }
+
+    stub = KintoneStub(apps, args.latency, args.error_rate, args.max_concurrent)
+    server = make_server(stub, args.host, args.port)
+    print(f"Kintone stub listening on http://{args.host}:{server.server_port} "
+          f"({', '.join(f'app {a}: {len(r)}' for a, r in apps.items())})")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -128,8 +128,8 @@ if uploaded_pdf:
                 st.write("Google Sheetsに接続中...")
                 # 0. Connect to Google Sheets FIRST (to get headers)
                 handler = SheetsHandler("temp_creds.json", SPREADSHEET_URL)
-                current_df = handler.get_current_data()
-                sheet_headers = current_df.columns.tolist()
+                # Header row only; the rows themselves are read once, when writing
+                sheet_headers = handler.get_headers()
 
                 st.write("PDFからデータを抽出中...")
                 # 1. Extract PDF headers and data
@@ -155,7 +155,7 @@ if uploaded_pdf:
                 
                 # 3. Write Data Immediately
                 st.write("Google Sheetsへの書き込みを開始...")
-                result_msg = handler.clear_and_write_data(pdf_data, header_mapping)
+                result_msg = handler.clear_and_write_data(pdf_data, header_mapping, diff=True)
                 
                 if "Success" in result_msg:
                     status.update(label="✅ 全工程完了！", state="complete", expanded=False)
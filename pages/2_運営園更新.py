@@ -23,9 +23,14 @@ st.set_page_config(
 
 # Import modules
 try:
-    from kintone_client import get_nursery_data, get_bed_data
-    from data_processor import merge_data
-    from excel_manager import update_excel
+    from kintone_client import get_all_data
+    from kintone_snapshot import SnapshotStore
+    from data_processor import merge_data, match_summary
+    from excel_manager import (
+        update_excel, write_excel_streaming, write_excel_patch,
+        load_previous_output, save_previous_output
+    )
+    from data_export import export_snapshot
 except ImportError:
     st.error("必要なモジュールが見つかりません")
 
@@ -34,6 +39,11 @@ KINTONE_TOKEN_NURSERY = os.getenv("KINTONE_API_TOKEN_NURSERY", "")
 KINTONE_TOKEN_CLIENT = os.getenv("KINTONE_API_TOKEN_CLIENT", "")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 GOOGLE_CREDS_JSON = os.getenv("GOOGLE_CREDENTIALS_JSON", "")
+# "1": fetch only bed records of open nurseries (exact name match only)
+KINTONE_BED_PUSHDOWN = os.getenv("KINTONE_BED_PUSHDOWN", "") == "1"
+# How the Excel file is written: "stream" (default), "patch" (rewrite the template's
+# rows in place, shared strings) or "openpyxl" (full load/save)
+EXCEL_WRITE_MODE = os.getenv("EXCEL_WRITE_MODE", "stream")
 import json
 # Write credentials to temp file if env var is set
 if GOOGLE_CREDS_JSON:
@@ -122,12 +132,18 @@ if st.button("更新データを作成する", type="primary"):
     # 1. Fetch Data
     with st.status("データ取得中...", expanded=True) as status:
         try:
-            st.write("Kintoneから保育園情報を取得中...")
-            nursery_records = get_nursery_data(KINTONE_TOKEN_NURSERY)
+            # Local snapshot: only records changed since the last run are downloaded
+            store = SnapshotStore()
+            try:
+                # Both apps are fetched concurrently
+                st.write("Kintoneから保育園情報・病床数データを取得中...")
+                nursery_records, bed_records = get_all_data(
+                    KINTONE_TOKEN_NURSERY, KINTONE_TOKEN_CLIENT, store=store,
+                    bed_pushdown=KINTONE_BED_PUSHDOWN
+                )
+            finally:
+                store.close()
             st.write(f"保育園情報: {len(nursery_records)}件 取得")
-            
-            st.write("Kintoneから病床数データを取得中...")
-            bed_records = get_bed_data(KINTONE_TOKEN_CLIENT)
             st.write(f"病床数データ: {len(bed_records)}件 取得")
             
             status.update(label="データ取得完了", state="complete", expanded=False)
@@ -139,8 +155,28 @@ if st.button("更新データを作成する", type="primary"):
     with st.status("データ処理＆名寄せ中...", expanded=True) as status:
         try:
             os.environ["GEMINI_API_KEY"] = GEMINI_API_KEY or ""
-            merged_data = merge_data(nursery_records, bed_records)
+            # Names not resolved by the normalization index go to Gemini in batches
+            match_errors = []
+            merged_data = merge_data(
+                nursery_records, bed_records,
+                use_gemini=bool(GEMINI_API_KEY), errors=match_errors
+            )
+            for msg in match_errors:
+                st.warning(msg)
             st.write(f"結合完了: {len(merged_data)}件")
+            # Which normalization rule matched each nursery (exact / nfkc / kana / stripped ...)
+            summary = match_summary(merged_data)
+            st.write("名寄せ内訳: " + ", ".join(f"{rule} {count}件" for rule, count in summary.most_common()))
+            # n-gram matches are not exact: list them for review
+            ngram_matches = [m for m in merged_data if m["match_rule"] == "ngram"]
+            if ngram_matches:
+                with st.expander(f"n-gram一致（要確認）: {len(ngram_matches)}件"):
+                    for m in ngram_matches:
+                        bed_names = sorted({b.get("保育園", "") for b in m["bed"] or []})
+                        st.write(f"- {m['master'].get('name', '')} → {', '.join(bed_names)}")
+            conflicts = sum(1 for m in merged_data if m["bed_conflict"])
+            if conflicts:
+                st.write(f"病床数の不一致（複数レコード）: {conflicts}件")
             status.update(label="処理完了", state="complete", expanded=False)
         except Exception as e:
             st.error(f"データ処理エラー: {e}")
@@ -149,16 +185,54 @@ if st.button("更新データを作成する", type="primary"):
     # 3. Excel Update
     with st.status("Excel更新中...", expanded=True) as status:
         try:
-            # Pass the local filename directly
-            wb = update_excel(template_path, merged_data, target_date)
-            
-            # Write Today's Date to N1
-            ws = wb.worksheets[0]
-            ws['N1'] = target_date.strftime("%Y/%m/%d")
+            # Previous run's output: change summary, and in patch/openpyxl mode
+            # only the rows that changed are rewritten
+            previous, previous_fp = load_previous_output(template_path)
+            changes = {}
             
             output = BytesIO()
-            wb.save(output)
+            if EXCEL_WRITE_MODE == "stream":
+                # Template entries are copied as-is, only the extract sheet is written (N1 included)
+                sheet_rows = write_excel_streaming(
+                    template_path, merged_data, target_date, output,
+                    previous=previous, changes=changes, fingerprint=previous_fp
+                )
+            elif EXCEL_WRITE_MODE == "patch":
+                sheet_rows = write_excel_patch(
+                    template_path, merged_data, target_date, output,
+                    previous=previous, changes=changes, fingerprint=previous_fp
+                )
+            else:
+                # Pass the local filename directly
+                wb = update_excel(template_path, merged_data, target_date, previous=previous, changes=changes)
+                
+                # Write Today's Date to N1
+                ws = wb.worksheets[0]
+                ws['N1'] = target_date.strftime("%Y/%m/%d")
+                
+                wb.save(output)
+                sheet_rows = [list(row) for row in ws.iter_rows(values_only=True)]
             output.seek(0)
+            save_previous_output(template_path, output.getvalue(), sheet_rows)
+            
+            # Typed copy of the merged rows (Parquet, or .csv.gz without a Parquet engine)
+            try:
+                export_path = export_snapshot(merged_data, target_date)
+                st.write(f"データ出力: {export_path}")
+            except Exception as e:
+                st.warning(f"データ出力エラー: {e}")
+            
+            if previous is not None:
+                st.write(
+                    f"前回からの変更: 追加 {len(changes['added'])}件 / "
+                    f"削除 {len(changes['removed'])}件 / 変更 {len(changes['changed'])}件"
+                )
+                for name in changes["added"]:
+                    st.write(f"- 追加: {name}")
+                for name in changes["removed"]:
+                    st.write(f"- 削除: {name}")
+                for name, fields in changes["changed"].items():
+                    st.write(f"- 変更: {name}（{', '.join(fields)}）")
             
             status.update(label="Excel生成完了", state="complete", expanded=False)
             
@@ -172,11 +246,12 @@ if st.button("更新データを作成する", type="primary"):
     
     with st.status("Google Sheetsに同期中...", expanded=True) as status:
         try:
-            # Extract data from the first worksheet of the GENERATED workbook
-            ws = wb.worksheets[0]
-            # Convert worksheet to list of lists (values only)
+            # Rows of the first worksheet of the GENERATED workbook
+            # Convert to list of lists (values only)
+            width = max((len(row) for row in sheet_rows), default=0)
             data_to_sync = []
-            for row in ws.iter_rows(values_only=True):
+            for row in sheet_rows:
+                row = list(row) + [None] * (width - len(row))
                 # Convert datetime objects to string if needed, or rely on gspread's handling
                 # Gspread usually handles basic types. Dates might need formatting.
                 # Let's simple-cast everything to str to be safe, or let gspread handle it.
@@ -214,7 +289,8 @@ if st.button("更新データを作成する", type="primary"):
                     sync_status_msg = "⚠️ 同期対象のデータがありませんでした"
                     sync_success = False
                 else:
-                    sync_result = handler.write_values(data_to_sync)
+                    # Only changed cells are sent; the sheet is never cleared first
+                    sync_result = handler.sync_values(data_to_sync)
                     
                     if "Success" in sync_result:
                         status.update(label="✅ Google Sheets同期完了", state="complete", expanded=False)
@@ -0,0 +1,18 @@
+import random
+
+# Retry policy shared by the Kintone client and the Google Sheets handler
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0 # seconds, doubled per attempt
+BACKOFF_MAX = 30.0
+# 429 / 5xx: throttling (Kintone's concurrent request limit, Sheets quota), transient errors
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+def backoff(attempt, retry_after=None):
+    """
+    Seconds to wait before retry number `attempt` (0-based).
+    A numeric Retry-After header value is honoured (capped at BACKOFF_MAX).
+    """
+    if retry_after and str(retry_after).isdigit():
+        return min(float(retry_after), BACKOFF_MAX)
+    # Full jitter so that parallel workers do not retry in lockstep
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
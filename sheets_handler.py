@@ -1,8 +1,156 @@
 
 import gspread
+from gspread.utils import rowcol_to_a1, absolute_range_name
 from oauth2client.service_account import ServiceAccountCredentials
 import pandas as pd
 import os
+import json
+import time
+import hashlib
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+from retry_policy import MAX_RETRIES, RETRY_STATUS, backoff
+
+def normalize_key(value):
+    """Key as compared between the sheet and the PDF data: text, trimmed, NaN/None -> ""."""
+    if value is None or (isinstance(value, float) and value != value):
+        return ""
+    return str(value).strip()
+
+# Bulk writes are split into chunks of at most WRITE_CHUNK_CELLS cells,
+# sent by WRITE_WORKERS threads, each retried on 429/5xx with backoff.
+WRITE_CHUNK_CELLS = 40000
+WRITE_WORKERS = 3
+# Committed chunks of an unfinished write, so a failed sync resumes;
+# one file per write target in this directory
+WRITE_CHECKPOINT_DIR = os.getenv("SHEETS_WRITE_CHECKPOINT_DIR", ".")
+
+def _retry(fn, *args, **kwargs):
+    """Call fn, retrying throttling/server/connection errors with jittered backoff."""
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            response = getattr(e, "response", None)
+            status = getattr(response, "status_code", None)
+            if status not in RETRY_STATUS or attempt == MAX_RETRIES:
+                raise
+            retry_after = response.headers.get("Retry-After") if response is not None else None
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == MAX_RETRIES:
+                raise
+            retry_after = None
+        time.sleep(backoff(attempt, retry_after))
+
+def chunk_rows(rows, max_cells=None):
+    """Split rows into consecutive [(offset, rows), ...] of at most max_cells cells (at least one row each)."""
+    max_cells = max_cells or WRITE_CHUNK_CELLS
+    chunks = []
+    start, cells = 0, 0
+    for i, row in enumerate(rows):
+        n = max(len(row), 1)
+        if i > start and cells + n > max_cells:
+            chunks.append((start, rows[start:i]))
+            start, cells = i, 0
+        cells += n
+    if start < len(rows):
+        chunks.append((start, rows[start:]))
+    return chunks
+
+class WriteCheckpoint:
+    """
+    Chunks already written for one write: target identifies where the rows
+    go (spreadsheet, worksheet, range), key the data. Stored as JSON in a
+    file named after target, so writes to other targets keep their own
+    state; a different key starts over.
+    """
+
+    def __init__(self, target, key, path=None):
+        self.key = key
+        if path is None:
+            name = hashlib.sha256(target.encode("utf-8")).hexdigest()[:16]
+            path = os.path.join(WRITE_CHECKPOINT_DIR, f"sheets_write_checkpoint_{name}.json")
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("key") == key:
+                self.done = set(state.get("done", []))
+        except (OSError, ValueError):
+            pass
+
+    def commit(self, index):
+        with self.lock:
+            self.done.add(index)
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump({"key": self.key, "done": sorted(self.done)}, f)
+
+    def finish(self):
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+# Diff sync: unchanged cells between two changed cells of a row are rewritten
+# (same value) when the gap is at most this wide, to keep ranges few.
+DIFF_MERGE_GAP = 3
+
+def _cell_text(value):
+    return "" if value is None else str(value)
+
+def diff_ranges(current, new_rows, start_row=1, merge_gap=DIFF_MERGE_GAP):
+    """
+    Changed cells between the sheet's current values and new_rows (both
+    lists of rows, starting at start_row), coalesced into rectangles.
+    Returns ([(row, col, values), ...], first_stale_row): each rectangle has
+    its top-left (1-based) and a 2D list of values; rows from
+    first_stale_row on (None if none) exist only in current.
+    """
+    width = max([len(r) for r in current] + [len(r) for r in new_rows] + [0])
+    
+    # Runs of changed columns per row: {row: [(c0, c1), ...]} (0-based, inclusive)
+    runs = []
+    for i, row in enumerate(new_rows):
+        old = current[i] if i < len(current) else []
+        row_runs = []
+        for c in range(width):
+            new_val = _cell_text(row[c]) if c < len(row) else ""
+            old_val = old[c] if c < len(old) else ""
+            if new_val == old_val:
+                continue
+            if row_runs and c - row_runs[-1][1] <= merge_gap + 1:
+                row_runs[-1][1] = c
+            else:
+                row_runs.append([c, c])
+        runs.append([tuple(r) for r in row_runs])
+    
+    # Stack identical column runs of consecutive rows into one rectangle
+    rects = []
+    open_rects = {} # (c0, c1) -> [first row index, last row index]
+    for i, row_runs in enumerate(runs + [[]]):
+        for span in list(open_rects):
+            if span not in row_runs:
+                first, last = open_rects.pop(span)
+                rects.append((first, last, span))
+        for span in row_runs:
+            if span in open_rects:
+                open_rects[span][1] = i
+            else:
+                open_rects[span] = [i, i]
+    
+    ranges = []
+    for first, last, (c0, c1) in sorted(rects):
+        values = [
+            [_cell_text(new_rows[i][c]) if c < len(new_rows[i]) else "" for c in range(c0, c1 + 1)]
+            for i in range(first, last + 1)
+        ]
+        ranges.append((start_row + first, c0 + 1, values))
+    
+    first_stale_row = start_row + len(new_rows) if len(current) > len(new_rows) else None
+    return ranges, first_stale_row
 
 class SheetsHandler:
     def __init__(self, credentials_json, sheet_url, sheet_name=None):
@@ -27,10 +175,51 @@ class SheetsHandler:
                 raise ValueError(f"Sheet '{sheet_name}' not found.")
         else:
             self.worksheet = self.sh.get_worksheet(0) # Assume first sheet
+        
+        # Read cache: one full read per handler (i.e. per run), dropped after writes
+        self._values = None
+        self._values_revision = None
+        self._headers = None
+
+    def get_headers(self):
+        """Header row only: one small range read (cached), not the whole sheet."""
+        if self._headers is None:
+            if self._values is not None:
+                self._headers = list(self._values[0]) if self._values else []
+            else:
+                self._headers = _retry(self.worksheet.row_values, 1)
+        return self._headers
+
+    def get_values(self, validate=False):
+        """
+        All cell values (list of rows), downloaded once per handler.
+        validate=True first checks the spreadsheet's last update time (one
+        Drive metadata call) and re-reads only if it changed.
+        """
+        if self._values is not None and validate and self._revision() != self._values_revision:
+            self._values = None
+        if self._values is None:
+            revision = self._revision() if validate else None
+            self._values = _retry(self.worksheet.get_all_values)
+            self._values_revision = revision
+            self._headers = list(self._values[0]) if self._values else []
+        return self._values
+
+    def _revision(self):
+        try:
+            return self.sh.get_lastUpdateTime()
+        except Exception:
+            return None
+
+    def _invalidate(self):
+        """Forget cached reads after writing to the sheet."""
+        self._values = None
+        self._values_revision = None
+        self._headers = None
 
     def get_current_data(self):
         """Fetches all data as a DataFrame."""
-        data = self.worksheet.get_all_values()
+        data = self.get_values()
         headers = data[0]
         rows = data[1:]
         return pd.DataFrame(rows, columns=headers)
@@ -40,8 +229,8 @@ class SheetsHandler:
         Updates the sheet based on matching keys.
         Preserves Column A (index 0).
         """
-        # Fetch current data
-        current_data = self.worksheet.get_all_values()
+        # Fetch current data (cached per run)
+        current_data = self.get_values()
         headers = current_data[0]
         
         # Map headers to column indices
@@ -52,10 +241,6 @@ class SheetsHandler:
             
         key_idx = col_map[key_col_sheet]
         
-        # Prepare updates
-        # List of Cell objects to batch update
-        cells_to_update = []
-        
         # Create a lookup for PDF data
         # pdf_df should be standardized. 
         # We need a mapping from Sheet Column Name -> PDF Column Name
@@ -71,61 +256,72 @@ class SheetsHandler:
             # Add more as needed
         }
         
-        # Iterate through sheet rows (skipping header)
-        # We use enumerate starting from 2 (row 1 is header, 1-based index for gspread)
-        updated_count = 0
+        # Index the PDF side once by normalized key (first row wins, as before)
+        pdf_keys = pdf_df[key_col_pdf].map(normalize_key)
+        dup_mask = pdf_keys.duplicated(keep=False) & (pdf_keys != "")
+        duplicate_keys = sorted(set(pdf_keys[dup_mask]))
+        if duplicate_keys:
+            print(f"Duplicate keys in PDF data ({len(duplicate_keys)}), first row used: {duplicate_keys[:10]}")
+        first = ~pdf_keys.duplicated() & (pdf_keys != "")
+        pdf_index = pdf_df[first].set_index(pdf_keys[first])
         
-        for i, row in enumerate(current_data[1:], start=2):
-            sheet_key_val = row[key_idx]
-            
-            # Find matching row in PDF Data
-            match = pdf_df[pdf_df[key_col_pdf].astype(str) == str(sheet_key_val)]
-            
-            if not match.empty:
-                pdf_row = match.iloc[0]
-                row_changed = False
-                
-                for sheet_col, pdf_col in mapping.items():
-                    if sheet_col in col_map and pdf_col in pdf_row:
-                        col_idx = col_map[sheet_col]
-                        new_val = str(pdf_row[pdf_col])
-                        current_val = row[col_idx]
-                        
-                        if new_val != current_val:
-                            # Add to update list
-                            # gspread Use (row, col) 1-based
-                            cells_to_update.append(
-                                gspread.Cell(row=i, col=col_idx+1, value=new_val)
-                            )
-                            row_changed = True
-                            
-                if row_changed:
-                    updated_count += 1
+        # Sheet rows as a frame (skipping header), aligned with the PDF rows by key
+        # Row i of the frame is spreadsheet row i + 2 (1-based index for gspread)
+        width = len(headers)
+        sheet_df = pd.DataFrame([(row + [""] * width)[:width] for row in current_data[1:]], dtype=object)
+        if sheet_df.empty:
+            return "No changes needed."
+        sheet_keys = sheet_df[key_idx].map(normalize_key)
+        # Text before aligning: unmatched rows would turn int columns into float
+        aligned = pdf_index.astype(str).reindex(sheet_keys.values)
+        matched = sheet_keys.isin(pdf_index.index).values & (sheet_keys != "").values
+        
+        # Vectorized diff, one mapped column at a time
+        changes = []
+        for sheet_col, pdf_col in mapping.items():
+            if sheet_col in col_map and pdf_col in pdf_index.columns:
+                col_idx = col_map[sheet_col]
+                new_vals = aligned[pdf_col].values
+                differs = matched & (new_vals != sheet_df[col_idx].values)
+                for pos in differs.nonzero()[0]:
+                    changes.append((pos + 2, col_idx + 1, new_vals[pos]))
+        
+        # gspread Use (row, col) 1-based
+        changes.sort()
+        cells_to_update = [gspread.Cell(row=r, col=c, value=v) for r, c, v in changes]
+        updated_count = len({r for r, _, _ in changes})
                     
         if cells_to_update:
             print(f"Updating {len(cells_to_update)} cells across {updated_count} rows...")
             self.worksheet.update_cells(cells_to_update)
-            return f"Success: Updated {updated_count} rows."
+            self._invalidate()
+            msg = f"Success: Updated {updated_count} rows."
         else:
-            return "No changes needed."
+            msg = "No changes needed."
+        if duplicate_keys:
+            msg += f" Duplicate keys in PDF data (first row used): {', '.join(duplicate_keys)}"
+        return msg
 
-    def clear_and_write_data(self, pdf_data, header_mapping):
+    def clear_and_write_data(self, pdf_data, header_mapping, diff=False):
         """
         Clears all data (except header) and writes the new data.
         
         Args:
             pdf_data: list of dicts, each dict has PDF header names as keys
             header_mapping: dict mapping PDF header -> Spreadsheet header
+            diff: write only changed cells and clear only vanished rows
+                  instead of clearing everything first
         """
         print("[DEBUG] clear_and_write_data: START")
         
         # 1. Fetch current headers from spreadsheet
+        # (diff mode needs the current rows too; otherwise the header row is enough)
         print("[DEBUG] Step 1: Fetching headers...")
-        current_data = self.worksheet.get_all_values()
-        if not current_data:
+        current_data = self.get_values() if diff else None
+        sheet_headers = current_data[0] if current_data else self.get_headers() if not diff else []
+        if not sheet_headers:
             return "Error: Sheet is empty, cannot find headers."
-            
-        sheet_headers = current_data[0]
+
         print(f"[DEBUG] Sheet headers count: {len(sheet_headers)}")
         
         # 2. Build reverse mapping: Spreadsheet header -> column index
@@ -157,39 +353,159 @@ class SheetsHandler:
             print("[DEBUG] No rows to write!")
             return "Warning: No data to write (0 rows matched)."
         
-        # 4. Clear existing data
-        print("[DEBUG] Step 4: Clearing data...")
+        if diff:
+            print("[DEBUG] Step 4: Writing changed cells only...")
+            try:
+                return self._apply_diff(current_data[1:], new_rows, start_row=2)
+            except Exception as e:
+                print(f"[DEBUG] Write error: {e}")
+                return f"Error during write: {e}"
+        
+        # 4. Write new data over the old rows, in resumable chunks
+        print(f"[DEBUG] Step 4: Writing {len(new_rows)} rows...")
+        self._invalidate()
         try:
-            # Use simpler clear method
-            self.worksheet.batch_clear(["A2:ZZ10000"])
-            print("[DEBUG] Clear successful")
+            chunks = self._write_chunks(new_rows, start_row=2)
+            print(f"[DEBUG] Write successful ({chunks} chunks)")
         except Exception as e:
-            print(f"[DEBUG] Clear error: {e}")
-            return f"Error during clear: {e}"
+            print(f"[DEBUG] Write error: {e}")
+            return f"Error during write: {e} (progress saved, run again to resume)"
         
-        # 5. Write new data
-        print(f"[DEBUG] Step 5: Writing {len(new_rows)} rows...")
+        # 5. Clear what is left of the old data below
+        print("[DEBUG] Step 5: Clearing leftover rows...")
         try:
-            self.worksheet.update(values=new_rows, range_name="A2")
-            print("[DEBUG] Write successful")
-            return f"Success: Replaced all data with {len(new_rows)} records."
+            self._clear_outside(len(new_rows) + 1, len(sheet_headers), start_row=2)
+            print("[DEBUG] Clear successful")
         except Exception as e:
-            print(f"[DEBUG] Write error: {e}")
-            return f"Error during write: {e}"
+            print(f"[DEBUG] Clear error: {e}")
+            return f"Error during clear: {e}"
+        return f"Success: Replaced all data with {len(new_rows)} records."
 
     def write_values(self, data_rows):
         """
-        Writes a list of lists (raw rows) to the worksheet, clearing it first.
+        Writes a list of lists (raw rows) to the worksheet, replacing its contents.
         Args:
             data_rows: List[List[Any]]
+        The rows are written in chunks (see _write_chunks) over the old
+        contents, then whatever lies outside them is cleared. A failed write
+        resumes from the last committed chunk when called again with the same data.
         """
         try:
-            self.worksheet.clear()
             if not data_rows:
+                self.worksheet.clear()
+                self._invalidate()
                 return "Warning: No data to write."
             
-            self.worksheet.update(values=data_rows, range_name="A1")
-            return "Success: Written data to spreadsheet."
+            self._invalidate()
+            chunks = self._write_chunks(data_rows, start_row=1)
+            self._clear_outside(len(data_rows), max(len(r) for r in data_rows))
+            return f"Success: Written data to spreadsheet ({chunks} chunks)."
+        except Exception as e:
+            return f"Error writing values: {e} (progress saved, run again to resume)"
+
+    def _ensure_grid(self, rows, cols):
+        """Grow the worksheet so that rows x cols fits."""
+        if rows > self.worksheet.row_count:
+            _retry(self.worksheet.add_rows, rows - self.worksheet.row_count)
+        if cols > self.worksheet.col_count:
+            _retry(self.worksheet.add_cols, cols - self.worksheet.col_count)
+
+    def _clear_outside(self, rows, cols, start_row=1):
+        """Clear the cells below row `rows` and right of column `cols` (from start_row)."""
+        ranges = []
+        if self.worksheet.row_count > rows:
+            ranges.append(f"{rowcol_to_a1(rows + 1, 1)}:{rowcol_to_a1(self.worksheet.row_count, self.worksheet.col_count)}")
+        if self.worksheet.col_count > cols and rows >= start_row:
+            ranges.append(f"{rowcol_to_a1(start_row, cols + 1)}:{rowcol_to_a1(rows, self.worksheet.col_count)}")
+        if ranges:
+            _retry(self.worksheet.batch_clear, ranges)
+
+    def _write_chunks(self, rows, start_row=1):
+        """
+        Write rows from start_row in size-bounded chunks, WRITE_WORKERS at a
+        time, each retried with backoff. Written chunks are checkpointed and
+        skipped when the same write is repeated after a failure.
+        Returns the number of chunks.
+        """
+        width = max(len(r) for r in rows)
+        values = [[_cell_text(v) for v in r] + [""] * (width - len(r)) for r in rows]
+        self._ensure_grid(start_row + len(values) - 1, width)
+        
+        digest = hashlib.sha256(json.dumps(values, ensure_ascii=False).encode("utf-8")).hexdigest()
+        checkpoint = WriteCheckpoint(f"{self.sh.id}/{self.worksheet.id}/{start_row}", f"{WRITE_CHUNK_CELLS}/{digest}")
+        chunks = chunk_rows(values)
+        
+        def send(index, offset, chunk):
+            if index in checkpoint.done:
+                return
+            first = start_row + offset
+            range_name = absolute_range_name(
+                self.worksheet.title,
+                f"{rowcol_to_a1(first, 1)}:{rowcol_to_a1(first + len(chunk) - 1, width)}"
+            )
+            _retry(self.sh.values_update, range_name, params={"valueInputOption": "RAW"}, body={"values": chunk})
+            checkpoint.commit(index)
+        
+        with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as pool:
+            futures = [pool.submit(send, i, offset, chunk) for i, (offset, chunk) in enumerate(chunks)]
+            for f in futures:
+                f.result()
+        checkpoint.finish()
+        return len(chunks)
+
+    def _apply_diff(self, current, new_rows, start_row=1):
+        """
+        Write only the cells of new_rows that differ from current (the sheet's
+        values from start_row on), in one values.batchUpdate, then clear the
+        rows that disappeared. The sheet is never empty in between.
+        """
+        ranges, first_stale_row = diff_ranges(current, new_rows, start_row)
+        self._invalidate()
+        
+        # Grow the grid if the new data is larger
+        self._ensure_grid(start_row + len(new_rows) - 1, max([len(r) for r in new_rows] + [0]))
+        
+        data = [
+            {
+                "range": absolute_range_name(
+                    self.worksheet.title,
+                    f"{rowcol_to_a1(row, col)}:{rowcol_to_a1(row + len(values) - 1, col + len(values[0]) - 1)}"
+                ),
+                "values": values,
+            }
+            for row, col, values in ranges
+        ]
+        # Size-bounded batches; re-running a failed sync simply diffs again
+        batch, cells = [], 0
+        for item in data + [None]:
+            n = len(item["values"]) * len(item["values"][0]) if item else 0
+            if batch and (item is None or cells + n > WRITE_CHUNK_CELLS):
+                _retry(self.sh.values_batch_update, {"valueInputOption": "RAW", "data": batch})
+                batch, cells = [], 0
+            if item:
+                batch.append(item)
+                cells += n
+        
+        cleared = 0
+        if first_stale_row is not None:
+            last_row = start_row + len(current) - 1
+            width = max(len(r) for r in current)
+            _retry(self.worksheet.batch_clear, [f"{rowcol_to_a1(first_stale_row, 1)}:{rowcol_to_a1(last_row, width)}"])
+            cleared = last_row - first_stale_row + 1
+        
+        cells = sum(len(values) * len(values[0]) for _, _, values in ranges)
+        return f"Success: Updated {cells} cells in {len(ranges)} ranges, cleared {cleared} rows."
+
+    def sync_values(self, data_rows):
+        """
+        Like write_values, but reads the current values once and writes only
+        the changed cells (see _apply_diff) instead of clearing the sheet.
+        """
+        try:
+            if not data_rows:
+                return "Warning: No data to write."
+            current = self.get_values()
+            return self._apply_diff(current, data_rows)
         except Exception as e:
             return f"Error writing values: {e}"
 